@@ -0,0 +1,44 @@
+import importlib
+
+# Audit categories by the name used in profiles, given as module and
+# class. Modules are imported on first use, so that a run only loads
+# the categories of its profile and their dependencies.
+CATEGORIES = {
+              'dockerconf': ('dock', 'DockerConfAudit'),
+              'dockerfiles': ('dock', 'DockerFileAudit'),
+              'host': ('host', 'HostConfAudit'),
+              'container_imgs': ('containers', 'ContainerImgAudit'),
+              'container_runtime': ('containers', 'ContainerRuntimeAudit'),
+              }
+
+
+def load_category(name):
+  """Returns the audit class of a category"""
+  module, classname = CATEGORIES[name]
+  return getattr(importlib.import_module('audits.' + module), classname)
+
+
+def needs_session(names):
+  """Checks if any of the categories talks to the Docker daemon"""
+  return any(not load_category(name).local for name in names \
+             if name in CATEGORIES)
+
+
+def create_categories(session, procs, names=None):
+  """
+  Creates the audit categories of a run, by default all of them.
+  Categories using the Docker API share the session, the others share
+  the process table snapshot.
+  """
+  categories = {}
+  for name in names or CATEGORIES.keys():
+    if name not in CATEGORIES:
+      continue
+    auditclass = load_category(name)
+    if auditclass.local:
+      categories[name] = auditclass(procs=procs)
+    elif name == 'host':
+      categories[name] = auditclass(session=session, procs=procs)
+    else:
+      categories[name] = auditclass(session=session)
+  return categories
@@ -0,0 +1,361 @@
+import os
+import ssl
+import json
+import time
+import errno
+import select
+import socket
+import logging
+from collections import deque
+from urlparse import urlparse
+from docker.utils import parse_host
+
+import stats
+
+DEFAULT_TIMEOUT = 60
+POLL_INTERVAL = 500
+
+# Engine API endpoints of the documents which can be fetched
+ENDPOINTS = {
+  'inspect': '/containers/%s/json',
+  'top': '/containers/%s/top',
+  'image': '/images/%s/json',
+  'history': '/images/%s/history',
+  }
+
+
+class StaleConnection(Exception):
+  """A kept-alive connection was closed by the daemon before replying"""
+
+
+class Response(object):
+  """Incremental parser of an HTTP/1.1 response"""
+
+  def __init__(self):
+    self.buffer = ''
+    self.status = None
+    self.headers = {}
+    self.body = []
+    self.received = 0
+    self.length = None
+    self.chunked = False
+    self.chunk_state = 'size'
+    self.chunk_left = 0
+    self.keep_alive = True
+    self.complete = False
+
+  def feed(self, data):
+    self.received += len(data)
+    self.buffer += data
+    if self.status is None:
+      end = self.buffer.find('\r\n\r\n')
+      if end < 0:
+        return
+      self.parse_head(self.buffer[:end])
+      self.buffer = self.buffer[end + 4:]
+    if self.chunked:
+      self.read_chunks()
+    elif self.length is not None:
+      self.body.append(self.buffer)
+      self.length -= len(self.buffer)
+      self.buffer = ''
+      if self.length <= 0:
+        self.complete = True
+    else:
+      self.body.append(self.buffer)
+      self.buffer = ''
+
+  def parse_head(self, head):
+    lines = head.split('\r\n')
+    version, status = lines[0].split(' ', 2)[:2]
+    self.status = int(status)
+    for line in lines[1:]:
+      name, _, value = line.partition(':')
+      self.headers[name.strip().lower()] = value.strip()
+    encoding = self.headers.get('transfer-encoding', '').lower()
+    self.chunked = 'chunked' in encoding
+    if not self.chunked and 'content-length' in self.headers:
+      self.length = int(self.headers['content-length'])
+      if self.length == 0:
+        self.complete = True
+    connection = self.headers.get('connection', '').lower()
+    self.keep_alive = version == 'HTTP/1.1' and connection != 'close'
+    if not self.chunked and self.length is None:
+      # Body ends when the daemon closes the connection
+      self.keep_alive = False
+
+  def read_chunks(self):
+    while not self.complete:
+      if self.chunk_state == 'size':
+        end = self.buffer.find('\r\n')
+        if end < 0:
+          return
+        self.chunk_left = int(self.buffer[:end].split(';')[0], 16)
+        self.buffer = self.buffer[end + 2:]
+        self.chunk_state = 'data' if self.chunk_left else 'trailer'
+      elif self.chunk_state == 'data':
+        if not self.buffer:
+          return
+        data = self.buffer[:self.chunk_left]
+        self.body.append(data)
+        self.chunk_left -= len(data)
+        self.buffer = self.buffer[len(data):]
+        if not self.chunk_left:
+          self.chunk_state = 'crlf'
+      elif self.chunk_state == 'crlf':
+        if len(self.buffer) < 2:
+          return
+        self.buffer = self.buffer[2:]
+        self.chunk_state = 'size'
+      else:
+        end = self.buffer.find('\r\n')
+        if end < 0:
+          return
+        line = self.buffer[:end]
+        self.buffer = self.buffer[end + 2:]
+        if not line:
+          self.complete = True
+
+  def eof(self):
+    """Handles the daemon closing the connection"""
+    if self.status is not None and not self.chunked and self.length is None:
+      self.complete = True
+    return self.complete
+
+
+class Connection(object):
+  """Non-blocking keep-alive connection to the Docker daemon"""
+
+  def __init__(self, fetcher):
+    self.fetcher = fetcher
+    self.sock = None
+    self.state = None
+    self.want = select.POLLOUT
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def start(self, job, path):
+    """Queues a GET request, opening the connection if needed"""
+    self.job = job
+    self.request = "GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: drydock\r\n"\
+                   "Accept: application/json\r\n\r\n" %(path, self.fetcher.host)
+    self.response = Response()
+    self.deadline = time.time() + self.fetcher.timeout
+    self.reused = self.sock is not None
+    if self.sock is None:
+      self.open()
+    else:
+      self.state = 'send'
+    self.want = select.POLLOUT
+
+  def open(self):
+    fetcher = self.fetcher
+    sock = socket.socket(fetcher.family, socket.SOCK_STREAM)
+    if fetcher.family == socket.AF_UNIX:
+      # Local connects complete immediately
+      sock.connect(fetcher.address)
+      sock.setblocking(0)
+      self.sock = sock
+      self.state = 'send'
+      return
+    sock.setblocking(0)
+    err = sock.connect_ex(fetcher.address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      sock.close()
+      raise socket.error(err, os.strerror(err))
+    self.sock = sock
+    self.state = 'connect'
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+  def process(self):
+    """
+    Advances the request as far as possible without blocking.
+    Returns True once the response is complete.
+    """
+    while True:
+      if self.state == 'connect':
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+          raise socket.error(err, os.strerror(err))
+        if self.fetcher.ssl_context:
+          self.sock = self.fetcher.ssl_context.wrap_socket(self.sock,
+                                                 do_handshake_on_connect=False)
+          self.state = 'handshake'
+        else:
+          self.state = 'send'
+      elif self.state == 'handshake':
+        try:
+          self.sock.do_handshake()
+        except socket.error as e:
+          if not self.would_block(e, select.POLLIN):
+            raise
+          return False
+        self.state = 'send'
+      elif self.state == 'send':
+        try:
+          sent = self.sock.send(self.request)
+        except socket.error as e:
+          if not self.would_block(e, select.POLLOUT):
+            raise
+          return False
+        self.request = self.request[sent:]
+        if not self.request:
+          self.state = 'recv'
+          self.want = select.POLLIN
+      else:
+        try:
+          data = self.sock.recv(65536)
+        except socket.error as e:
+          if not self.would_block(e, select.POLLIN):
+            raise
+          return False
+        if not data:
+          if self.response.eof():
+            return True
+          if self.reused and not self.response.received:
+            raise StaleConnection()
+          raise socket.error("Connection closed by the daemon")
+        self.response.feed(data)
+        if self.response.complete:
+          return True
+
+  def would_block(self, e, direction):
+    """Checks if a socket error only means that the call would block"""
+    if isinstance(e, ssl.SSLWantReadError):
+      self.want = select.POLLIN
+    elif isinstance(e, ssl.SSLWantWriteError):
+      self.want = select.POLLOUT
+    elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+      self.want = direction
+    else:
+      return False
+    return True
+
+
+class AsyncFetcher(object):
+  """
+  Fetches Engine API documents on a single thread. Requests run over a
+  bounded number of non-blocking keep-alive connections multiplexed with
+  poll(), so high concurrency costs neither a thread nor a docker-py
+  session per request.
+  """
+
+  def __init__(self, url, api_version, cert=None, key=None,
+               connections=8, timeout=DEFAULT_TIMEOUT):
+    addr = parse_host(url)
+    if addr.startswith('http+unix://'):
+      path = addr[len('http+unix://'):]
+      if not path.startswith('/'):
+        path = '/' + path
+      self.family = socket.AF_UNIX
+      self.address = path
+      self.host = 'localhost'
+    else:
+      parsed = urlparse(addr)
+      info = socket.getaddrinfo(parsed.hostname, parsed.port, 0,
+                                socket.SOCK_STREAM)[0]
+      self.family = info[0]
+      self.address = info[4]
+      self.host = parsed.netloc
+    self.ssl_context = None
+    if addr.startswith('https://'):
+      # Same settings as the docker-py client: no server verification
+      self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      self.ssl_context.verify_mode = ssl.CERT_NONE
+      if cert and key:
+        self.ssl_context.load_cert_chain(cert, key)
+    self.prefix = '/v%s' %api_version
+    self.connections = connections
+    self.timeout = timeout
+    self.idle = []
+
+  def fetch(self, jobs):
+    """
+    Fetches (kind, container or image) jobs and returns their documents in the
+    same order. Failed requests return None.
+    """
+    results = {}
+    pending = deque((job, False) for job in jobs)
+    active = {}
+    poller = select.poll()
+
+    while pending or active:
+      while pending and len(active) < self.connections:
+        job, retried = pending.popleft()
+        conn = self.idle.pop() if self.idle else Connection(self)
+        conn.retried = retried
+        try:
+          conn.start(job, self.prefix + ENDPOINTS[job[0]] %job[1])
+        except socket.error as e:
+          logging.debug("Fetch of %s for %s failed: %s" %(job[0], job[1], e))
+          conn.close()
+          results[job] = None
+          continue
+        active[conn.fileno()] = conn
+        poller.register(conn.fileno(), conn.want)
+
+      for fd, event in poller.poll(POLL_INTERVAL):
+        conn = active[fd]
+        try:
+          done = conn.process()
+        except StaleConnection:
+          self.finish(conn, poller, active, keep=False)
+          # Kept-alive connections can time out, retry on a new one
+          if conn.retried:
+            results[conn.job] = None
+          else:
+            pending.appendleft((conn.job, True))
+          continue
+        except (socket.error, ValueError) as e:
+          logging.debug("Fetch of %s for %s failed: %s" \
+                        %(conn.job[0], conn.job[1], e))
+          self.finish(conn, poller, active, keep=False)
+          results[conn.job] = None
+          continue
+        if done:
+          results[conn.job] = self.decode(conn)
+          self.finish(conn, poller, active, conn.response.keep_alive)
+        else:
+          poller.modify(fd, conn.want)
+
+      now = time.time()
+      for conn in active.values():
+        if now > conn.deadline:
+          logging.debug("Fetch of %s for %s timed out" \
+                        %(conn.job[0], conn.job[1]))
+          self.finish(conn, poller, active, keep=False)
+          results[conn.job] = None
+
+    return [results.get(job) for job in jobs]
+
+  def finish(self, conn, poller, active, keep):
+    fd = conn.fileno()
+    poller.unregister(fd)
+    del active[fd]
+    if keep:
+      self.idle.append(conn)
+    else:
+      conn.close()
+
+  def decode(self, conn):
+    response = conn.response
+    stats.record(sum(len(data) for data in response.body))
+    if response.status != 200:
+      logging.debug("Fetch of %s for %s returned %d" \
+                    %(conn.job[0], conn.job[1], response.status))
+      return None
+    try:
+      return json.loads(''.join(response.body))
+    except ValueError:
+      logging.debug("Invalid %s document for %s" %conn.job)
+      return None
+
+  def close(self):
+    for conn in self.idle:
+      conn.close()
+    self.idle = []
@@ -1,20 +1,39 @@
-import os
 import sys
+import time
 import logging
-import psutil
-from docker import Client
-from collections import defaultdict
+from processes import ProcessTable
+from stats import Meter
 
 BASE_URL = 'unix://var/run/docker.sock'
+# Status of checks which were not started before the deadline of a run
+SKIPPED = 'Skipped'
+# Part of the time left which the inspect prefetch of a time-budgeted run
+# may take, the rest is left to the checks
+PREFETCH_SHARE = 0.5
 
 class Audit(object):
+  #local categories and audits examine the machine drydock runs on
+  #instead of querying the Docker daemon
+  local = False
+  local_audits = ()
 
-  def __init__(self):
+  def __init__(self, procs=None):
     #logdict stores the results of the audit category,
     #templog is a temp dict which stores the result of each check
     #and gets cleared after each check
     self.logdict = {}
     self.templog = {}
+    #procs is the process table snapshot shared by process-based checks
+    self.procs = procs or ProcessTable()
+    #on_result is called with the name and results of each finished check
+    self.on_result = None
+    #timings of each check, and of the whole category once it ran
+    self.timings = {}
+    self.category_timings = None
+    #deadline of time-budgeted runs, checks are not started after it
+    self.deadline = None
+    #examined and running containers, when a budget left some out
+    self.partial = None
 
   def call(self,audit):
     """Reads YML profile and calls the equivelent method"""
@@ -24,35 +43,73 @@ class Audit(object):
       return logging.error("No audit named %s" %(audit))
 
   def call_with_args(self,audit):
-    """Same as call() but for methods with arguments"""
-    args = []
-    func = audit.keys()[0]
-    for argument in audit.values():
-      if type(argument) == dict:
-        for key,value in argument.iteritems():
-          args.append(value)
+    """Same as call() but for methods with arguments, bound by name"""
+    func, args = audit.items()[0]
     try:
-      return getattr(self,func)(*args)
+      return getattr(self,func)(**(args or {}))
     except AttributeError:
       return logging.error("No audit named %s" %(func))
 
   def run_audits(self,audits):
     for audit in audits:
-      if (type(audit) == str):
+      name = self.audit_names([audit])[0]
+      if self.out_of_time():
+        self.skip_audit(name)
+        continue
+      if isinstance(audit, basestring):
         logging.debug("Running %s with no args" %audit)
-        res = self.call(audit)
-        self.add_check_results(audit,res)
-      else:     
+        with Meter() as meter:
+          self.prepare(name)
+          res = self.call(audit)
+      else:
         logging.debug("Running %s with args %s" \
                       %(audit.keys()[0], audit.values()))
-        res = self.call_with_args(audit)
-        self.add_check_results(audit.keys()[0],res)
-    return 
+        with Meter() as meter:
+          self.prepare(name)
+          res = self.call_with_args(audit)
+      self.timings[name] = meter.as_dict()
+      self.add_check_results(name,res)
+    return
+
+  def prepare(self,audit_name):
+    """
+    Fetches the data only some checks need, before the first of them
+    runs, so that its cost is measured as part of that check
+    """
+    pass
+
+  def out_of_time(self):
+    """Tells if the deadline of a time-budgeted run has passed"""
+    return self.deadline is not None and time.time() >= self.deadline
+
+  def skip_audit(self,audit_name):
+    """Records a check which was not started in time, with no findings"""
+    logging.info("Out of time, skipping %s" %audit_name)
+    self.add_check_results(audit_name,
+                           {'status': SKIPPED,
+                            'descr': "Not started within the time budget"})
+
+  @staticmethod
+  def audit_names(audits):
+    """Returns the names of the audits in a profile category"""
+    names = []
+    for audit in audits:
+      if isinstance(audit, basestring):
+        names.append(audit)
+      else:
+        names.append(audit.keys()[0])
+    return names
 
   def add_check_results(self,audit_name,results):
     """Adds audit results to output dict"""
+    if self.partial and isinstance(results, dict) and 'descr' in results \
+       and results.get('status') != SKIPPED:
+      results['descr'] += ", %d of %d containers examined in time" \
+                          %self.partial
     self.logdict[audit_name] = results
     self.templog = {}
+    if self.on_result:
+      self.on_result(audit_name, results)
     return
 
   def running_containers(self):
@@ -60,9 +117,8 @@ class Audit(object):
     Helper method to determine if some checks should execute.
     """
     cont_ids = []
-    cli = self.cli
     try:
-      running_cont = cli.containers()
+      running_cont = self.session.containers()
     except:
       logging.error("Unable to connect to docker host. \
                     Verify that current user has permissions to use %s\
@@ -77,6 +133,34 @@ class Audit(object):
       logging.error("No running containers!")
       return None
 
+  def refresh(self):
+    """Re-reads the running containers after they changed"""
+    self.running = self.running_containers()
+    self.partial = None
+
+  def prefetch_running(self):
+    """
+    Fetches the inspect documents of the running containers, which every
+    container check reads. In a time-budgeted run, fetches stop after
+    PREFETCH_SHARE of the time left, so that checks get to run, and the
+    checks only examine the containers fetched by then.
+    """
+    if not self.running:
+      return
+    deadline = self.deadline
+    if deadline is not None:
+      deadline = time.time() + (deadline - time.time()) * PREFETCH_SHARE
+    self.session.snapshot.prefetch(self.running, deadline=deadline)
+    if deadline is None:
+      return
+    fetched = [cont for cont in self.running \
+               if cont in self.session.snapshot.inspected]
+    if len(fetched) < len(self.running):
+      logging.info("Out of time, examining %d of %d containers" \
+                   %(len(fetched), len(self.running)))
+      self.partial = (len(fetched), len(self.running))
+      self.running = fetched
+
   def check_inspect_value(self,value,dct,*args):
     """Compare a dict entry with a value. Args define depth."""
     key =args[0]
@@ -93,15 +177,20 @@ class Audit(object):
 
   def process_running(self,proc_name):
     """Check if process is running"""
-    procs = psutil.process_iter()
-    for proc in procs:
-      if (proc.name() == proc_name) :
-        cmd = proc.cmdline()
-        return cmd
+    for proc in self.procs.find(proc_name):
+      return proc['cmdline']
     logging.error("No process named %s.Are you sure %s is running?"\
                                               %(proc_name,proc_name))          
     return None
 
+  def docker_running(self):
+    """Returns the command line of the Docker daemon"""
+    proc = self.procs.docker_daemon()
+    if proc:
+      return proc['cmdline']
+    logging.error("No Docker daemon process found.Are you sure docker is running?")
+    return None
+
   def compare_dicts(self,source,exclude):
     """
     Compares keys,values of two dicts and produces a dict with their diff
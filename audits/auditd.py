@@ -0,0 +1,120 @@
+import os
+import glob
+import shlex
+import logging
+import subprocess
+
+# Rules files read when the loaded rules cannot be listed
+RULES_DIR = '/etc/audit/rules.d'
+# Watches without a permission filter cover every access
+ALL_PERMS = 'rwxa'
+
+
+def parse_rule(line):
+  """
+  Returns the path watched by an auditd rule, the permissions of the
+  watch and whether it covers a directory tree, or None for other rules.
+  Watches (-w path -p perms) and syscall rules on a path (-F path=...,
+  -F dir=... and -F perm=...) are understood, as printed by auditctl -l
+  or written in rules files, and so are the watch=/perm= fields of the
+  rule listings of old auditd versions.
+  """
+  try:
+    args = shlex.split(line, comments=True)
+  except ValueError:
+    logging.debug("Unable to parse auditd rule: %s" %line)
+    return None
+  path = perms = None
+  tree = False
+  fields = []
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    value = args[i + 1] if i + 1 < len(args) else ''
+    if arg in ('-a', '-A') and 'never' in value.split(','):
+      return None
+    if arg == '-w':
+      path = value
+    elif arg == '-p':
+      perms = value
+    elif arg == '-F':
+      fields.append(value)
+    elif '=' in arg and not arg.startswith('-'):
+      fields.append(arg)
+      i += 1
+      continue
+    i += 2
+  for field in fields:
+    key, op, value = field.partition('=')
+    if not op or key.endswith('!'):
+      continue
+    if key in ('path', 'watch'):
+      path = value
+    elif key == 'dir':
+      path, tree = value, True
+    elif key == 'perm':
+      perms = value
+  if not path:
+    return None
+  if len(path) > 1:
+    path = path.rstrip('/')
+  return path, perms or ALL_PERMS, tree
+
+
+class AuditRules(object):
+  """
+  Paths watched by auditd rules, indexed by path with the permissions
+  watched, so that checking a path is a lookup whatever the number of
+  rules. Directory rules (-F dir=) cover the paths below them.
+  """
+
+  def __init__(self, lines=()):
+    self.watches = {}
+    self.trees = set()
+    for line in lines:
+      self.add(line)
+
+  def add(self, line):
+    rule = parse_rule(line)
+    if rule is None:
+      return
+    path, perms, tree = rule
+    watched = set(self.watches.get(path, '')) | set(perms)
+    self.watches[path] = ''.join(p for p in ALL_PERMS if p in watched)
+    if tree:
+      self.trees.add(path)
+
+  def perms(self, path):
+    """Returns the permissions watched on a path, or None"""
+    if len(path) > 1:
+      path = path.rstrip('/')
+    if path in self.watches:
+      return self.watches[path]
+    parent = os.path.dirname(path)
+    while self.trees and parent != path:
+      if parent in self.trees:
+        return self.watches[parent]
+      path, parent = parent, os.path.dirname(parent)
+    return None
+
+  def __len__(self):
+    return len(self.watches)
+
+
+def loaded_rules():
+  """Returns the rules loaded in the kernel, listed by auditctl"""
+  with open(os.devnull, 'w') as devnull:
+    output = subprocess.check_output(['auditctl', '-l'], stderr=devnull)
+  return AuditRules(output.splitlines())
+
+
+def rule_files(rules_dir=RULES_DIR):
+  """Returns the rules of the rules files in a directory"""
+  lines = []
+  for fname in sorted(glob.glob(os.path.join(rules_dir, '*.rules'))):
+    try:
+      with open(fname) as f:
+        lines.extend(f.read().splitlines())
+    except IOError as e:
+      logging.warning("Unable to read %s: %s" %(fname, e))
+  return AuditRules(lines)
@@ -1,33 +1,126 @@
-import os
-import stat
-import psutil
 import logging
-from audit import Audit
-from docker import Client,tls
-from collections import defaultdict
+from audit import Audit, BASE_URL
+from rules import Rule, RuleEngine
+from layers import ImageScanner, SECRET_FILES, IMAGE_WORKERS, \
+                   format_findings
+from session import DockerSession
+from collections import defaultdict, OrderedDict
+from datetime import datetime
 from utils.decorators import assign_order
 
+# Runtime checks which only compare a single inspect field. They are
+# evaluated together by the rule engine in one pass over each container.
+RUNTIME_RULES = [
+  Rule('verify_apparmor', ['AppArmorProfile'], {'equals': ''},
+       passed="All containers have AppArmor profiles",
+       failed="%d container(s) with no AppArmor profile."),
+  Rule('verify_selinux', ['HostConfig', 'SecurityOpt'], {'equals': None},
+       passed="All containers have SELinux policies",
+       failed="%d containers with no SELinux policies."),
+  Rule('privileged_containers', ['HostConfig', 'Privileged'],
+       {'not_equals': False},
+       passed="No privileged containers detected.",
+       failed="%d privileged containers found"),
+  Rule('host_network_mode', ['HostConfig', 'NetworkMode'], {'equals': 'host'},
+       passed="All containers are inside a seperate network stack",
+       failed="%d container(s)' networking is not containerized"),
+  Rule('memory_usage_limit', ['HostConfig', 'Memory'], {'equals': 0},
+       passed="All containers have memory limits in place",
+       failed="%d container(s) have no memory limits"),
+  Rule('cpu_priority', ['HostConfig', 'CpuShares'], {'equals': 0},
+       passed="All containers have CPU shares in place",
+       failed="%d container(s) have no CPU shares set"),
+  Rule('readonly_root_fs', ['HostConfig', 'ReadonlyRootfs'], {'equals': False},
+       passed="All containers have read-only root FS",
+       failed="%d container(s) have writable root FS"),
+  Rule('host_process_namespace', ['HostConfig', 'PidMode'], {'equals': 'host'},
+       passed="All containers' process namespace is isolated",
+       failed="%d container(s) share host's process namespace"),
+  Rule('host_ipc_namespace', ['HostConfig', 'IpcMode'], {'equals': 'host'},
+       passed="All containers' process namespace is isolated",
+       failed="%d container(s) share host's process namespace"),
+  ]
 
 class ContainerImgAudit(Audit):
 
-  def __init__(self,url='unix://var/run/docker.sock', cert=None, key=None):
+  #checks examining the images of the running containers
+  image_audits = ('image_user', 'image_healthcheck', 'image_exposed_ports',
+                  'image_add_instructions', 'image_age', 'image_contents')
+  history_audits = ('image_add_instructions',)
+
+  def __init__(self,url=BASE_URL, cert=None, key=None, session=None):
     super(ContainerImgAudit, self).__init__()
-    if cert and key:
-      tls_config = tls.TLSConfig(verify=False, assert_hostname = False,\
-                                        client_cert = (cert, key))
-      print tls_config
-      self.cli = Client(base_url = url, tls = tls_config)
-    else:
-      self.cli = Client(base_url = url)
+    # The session (client, container listing and inspect snapshot) can be
+    # shared with the other audit categories
+    self.session = session or DockerSession(url, cert, key)
+    self.cli = self.session.cli
+    self.snapshot = self.session.snapshot
     self.running = self.running_containers()
 
+  def run_audits(self,audits):
+    # Every check reads the inspect documents, fetched once for all
+    self.prefetch_running()
+    return super(ContainerImgAudit, self).run_audits(audits)
+
+  def prepare(self,audit_name):
+    # Each image is fetched once, however many containers use it, by
+    # the first check examining images
+    if audit_name in self.image_audits:
+      self.snapshot.prefetch_images(self.images().keys(),
+                                    history=audit_name in self.history_audits)
+
+  def images(self):
+    """Returns the running containers by the ID of their image"""
+    images = OrderedDict()
+    for cont in self.running or []:
+      info = self.snapshot.inspect(cont)
+      images.setdefault(info['Image'], []).append(cont)
+    return images
+
+  def image_name(self,image):
+    """Returns the first tag of an image, or its ID if it has none"""
+    tags = [tag for tag in self.snapshot.image(image).get('RepoTags') or [] \
+            if tag != '<none>:<none>']
+    return tags[0] if tags else image
+
+  def evaluate_images(self,verdict):
+    """
+    Calls verdict with the inspect document of every image in use, once
+    per image, and returns the images it finds problems with, as
+    {image: {'containers': [...], 'findings': ...}}. verdict returns
+    the findings of an image, or nothing if it passes.
+    """
+    failed = OrderedDict()
+    for image, containers in self.images().iteritems():
+      try:
+        findings = verdict(image, self.snapshot.image(image))
+      except Exception as e:
+        logging.warning("Unable to examine image %s: %s" %(image, e))
+        continue
+      if findings:
+        failed[self.image_name(image)] = {'containers': containers,
+                                          'findings': findings}
+    return failed
+
+  def image_results(self,failed,fail_descr,pass_descr):
+    if failed:
+      containers = sum(len(res['containers']) for res in failed.values())
+      self.templog['status'] = 'Fail'
+      self.templog['descr'] = fail_descr %len(failed) + \
+                              ", used by %d container(s)" %containers
+      self.templog['output'] = failed
+    else:
+      self.templog['status'] = 'Pass'
+      self.templog['descr'] = pass_descr
+    return self.templog
+
   @assign_order(1)
   def container_user(self):
     """4.1 Create a user for the container"""
     nouser = []
     try:
       for container in self.running:
-        info = self.cli.inspect_container(container)
+        info = self.snapshot.inspect(container)
         root = self.check_inspect_value(0, info, 'Config', 'User')
         if root == False:
           nouser.append(container)
@@ -43,64 +136,201 @@ class ContainerImgAudit(Audit):
       self.templog['descr'] = "No container running as root"
     return self.templog
 
+  @assign_order(2)
+  def image_user(self):
+    """4.1 Create a user for the container image"""
+    def verdict(image, info):
+      if not info['Config'].get('User'):
+        return "No USER"
+    return self.image_results(self.evaluate_images(verdict),
+                              "%d image(s) run as root by default",
+                              "All images set a user")
+
+  @assign_order(3)
+  def image_healthcheck(self):
+    """4.6 Add HEALTHCHECK instruction to the container image"""
+    def verdict(image, info):
+      if not info['Config'].get('Healthcheck'):
+        return "No HEALTHCHECK"
+    return self.image_results(self.evaluate_images(verdict),
+                              "%d image(s) without health checks",
+                              "All images have health checks")
+
+  @assign_order(4)
+  def image_exposed_ports(self,allowed=None):
+    """Expose only needed ports in the container image"""
+    # Ports are allowed on any protocol (80) or on one ("53/udp")
+    allowed = set(str(port) for port in allowed or [])
+    def verdict(image, info):
+      ports = info['Config'].get('ExposedPorts') or {}
+      return sorted(port for port in ports \
+                    if port not in allowed and \
+                    port.split('/')[0] not in allowed)
+    return self.image_results(self.evaluate_images(verdict),
+                              "%d image(s) expose unneeded ports",
+                              "Images only expose needed ports")
+
+  @assign_order(5)
+  def image_add_instructions(self):
+    """4.9 Use COPY instead of ADD in Dockerfile"""
+    def verdict(image, info):
+      found = []
+      for layer in self.snapshot.history(image):
+        created_by = layer.get('CreatedBy') or ''
+        instruction = created_by.split('#(nop) ', 1)[-1].strip()
+        if not instruction.startswith('ADD '):
+          continue
+        # Base images are built by adding a root filesystem
+        if instruction.startswith('ADD file:') and \
+           instruction.endswith(' in /'):
+          continue
+        found.append(instruction)
+      return found
+    return self.image_results(self.evaluate_images(verdict),
+                              "%d image(s) built with ADD instructions",
+                              "No image built with ADD instructions")
+
+  @assign_order(6)
+  def image_age(self,max_days=365):
+    """Rebuild container images regularly"""
+    now = datetime.utcnow()
+    def verdict(image, info):
+      created = datetime.strptime(info['Created'][:19], '%Y-%m-%dT%H:%M:%S')
+      days = (now - created).days
+      if days > max_days:
+        return "Created %d days ago" %days
+    return self.image_results(self.evaluate_images(verdict),
+                              "%%d image(s) older than %d days" %max_days,
+                              "All images are recent")
+
+  @assign_order(7)
+  def image_contents(self,secrets=None):
+    """Scan image filesystems for setuid/setgid, world-writable and secret files"""
+    images = {}
+    for image in self.images():
+      try:
+        images[image] = self.snapshot.image(image)
+      except Exception as e:
+        logging.warning("Unable to inspect image %s: %s" %(image, e))
+    scanner = ImageScanner(self.cli, self.session.layers,
+                           secrets or SECRET_FILES,
+                           min(IMAGE_WORKERS, self.snapshot.workers))
+    findings = scanner.scan(images)
+    def verdict(image, info):
+      if findings.get(image):
+        return format_findings(findings[image])
+    failed = self.evaluate_images(verdict)
+    # Images which could not be read fail rather than pass unread
+    unscanned = len([res for res in failed.itervalues() \
+                     if 'not_scanned' in res['findings']])
+    fail_descr = "%d image(s) with risky files"
+    if unscanned:
+      fail_descr = "%%d image(s) with risky files or not scanned " \
+                   "(%d not scanned)" %unscanned
+    return self.image_results(failed, fail_descr,
+                              "No risky files found in images")
+
 
 class ContainerRuntimeAudit(Audit):
 
-  def __init__(self,url='unix://var/run/docker.sock', cert=None, key=None):
+  top_audits = ('single_process', 'ssh_running')
+  #built-in rules, profiles can add more
+  runtime_rules = RUNTIME_RULES
+
+  def __init__(self,url=BASE_URL, cert=None, key=None, session=None):
     super(ContainerRuntimeAudit, self).__init__()
-    if cert and key:
-      print "contrun %s %s" %(cert,key)
-      tls_config = tls.TLSConfig(verify = False,assert_hostname = False,\
-                                        client_cert = (cert, key))
-      self.cli = Client(base_url = url, tls = tls_config)
-    else:
-      self.cli = Client(base_url = url)
+    # The session (client, container listing and inspect snapshot) can be
+    # shared with the other audit categories
+    self.session = session or DockerSession(url, cert, key)
+    self.cli = self.session.cli
+    self.snapshot = self.session.snapshot
     self.running = self.running_containers()
+    self.rules = OrderedDict((rule.name, rule) \
+                             for rule in self.runtime_rules)
+    self.verdicts = {}
+    self.pending_rules = []
+
+  def run_audits(self,audits):
+    audits = self.load_rules(audits)
+    # Rules are evaluated together when the first of them runs
+    self.pending_rules = [name for name in self.audit_names(audits) \
+                          if name in self.rules]
+    self.prefetch_running()
+    return super(ContainerRuntimeAudit, self).run_audits(audits)
+
+  def prepare(self,audit_name):
+    # Process lists are only needed by the checks examining processes
+    if audit_name in self.top_audits:
+      self.snapshot.prefetch(self.running, top=True)
+    elif audit_name in self.rules:
+      self.evaluate_rules(self.pending_rules)
+
+  def refresh(self):
+    super(ContainerRuntimeAudit, self).refresh()
+    self.verdicts = {}
+
+  def load_rules(self,audits):
+    """
+    Registers the rules defined in a profile category and replaces
+    their definitions with the name of the check. A rule redefining a
+    check listed before it takes its place, so each check runs once.
+    """
+    loaded = []
+    for audit in audits:
+      if type(audit) == dict and audit.keys()[0] == 'rule':
+        try:
+          rule = Rule.from_profile(audit['rule'],
+                                   order=100 + len(loaded))
+        except ValueError as e:
+          logging.error("Invalid rule definition: %s" %e)
+          continue
+        if hasattr(self, rule.name) and rule.name not in self.rules:
+          logging.error("Rule %s conflicts with an audit" %rule.name)
+          continue
+        self.add_rule(rule)
+        if rule.name not in loaded:
+          loaded.append(rule.name)
+      elif audit not in loaded:
+        loaded.append(audit)
+    return loaded
+
+  def add_rule(self,rule):
+    """Exposes a profile-defined rule as a check of this category"""
+    self.rules[rule.name] = rule
+    self.verdicts.pop(rule.name, None)
+    check = lambda: self.rule_results(rule.name)
+    check.__doc__ = rule.descr
+    check.order = rule.order
+    setattr(self, rule.name, check)
+
+  def evaluate_rules(self,names):
+    """Evaluates the given rules in one pass over all containers"""
+    # Names listed twice would report their containers twice
+    names = OrderedDict.fromkeys(names).keys()
+    rules = [self.rules[name] for name in names if name not in self.verdicts]
+    if not rules or self.running is None:
+      return
+    documents = ((cont, self.snapshot.inspect(cont)) for cont in self.running)
+    engine = RuleEngine(rules)
+    self.verdicts.update(engine.evaluate(documents, self.session.verdicts))
+
+  def rule_results(self,name):
+    """Reports the containers failing a rule"""
+    if self.running is None:
+      return None
+    self.evaluate_rules([name])
+    self.templog.update(self.rules[name].results(self.verdicts[name]))
+    return self.templog
 
   @assign_order(1)
   def verify_apparmor(self):
     """5.1 Verify AppArmor profile"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        noapparmor = self.check_inspect_value('', info, 'AppArmorProfile')
-        if noapparmor == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) with no AppArmor profile."\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers have AppArmor profiles"
-    return self.templog
+    return self.rule_results('verify_apparmor')
 
   @assign_order(2)
   def verify_selinux(self):
     """5.2 Verify SELinux security options"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        noselinux = self.check_inspect_value(None, info, \
-                                             'HostConfig','SecurityOpt')
-        if noselinux == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d containers with no SELinux policies."\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers have SELinux policies"
-    return self.templog
+    return self.rule_results('verify_selinux')
 
   @assign_order(3)
   def single_process(self):
@@ -108,7 +338,7 @@ class ContainerRuntimeAudit(Audit):
     badconts = []
     try:
       for container in self.running:
-        processes = self.cli.top(container)['Processes']
+        processes = self.snapshot.top(container)['Processes']
         procnames = []
         for process in processes:
           procnames.append(process[7])
@@ -132,7 +362,7 @@ class ContainerRuntimeAudit(Audit):
     container_caps = {}
     try:
       for container in self.running:
-        info = self.cli.inspect_container(container)
+        info = self.snapshot.inspect(container)
         caps = defaultdict(list)
         capadd = info['HostConfig']['CapAdd']
         if capadd:
@@ -155,26 +385,7 @@ class ContainerRuntimeAudit(Audit):
   @assign_order(5)
   def privileged_containers(self):
     """5.5 Do not use privileged containers"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        nopriv = self.check_inspect_value(False, info, \
-                                             'HostConfig','Privileged')
-        if nopriv == False:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d privileged containers found"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "No privileged containers detected."
-    return self.templog
+    return self.rule_results('privileged_containers')
 
   @assign_order(6)
   def mounted_hostdirs(self):
@@ -185,7 +396,7 @@ class ContainerRuntimeAudit(Audit):
     badconts = defaultdict(list)
     try:
       for container in self.running:
-        info = self.cli.inspect_container(container)
+        info = self.snapshot.inspect(container)
         mounts = info['Mounts']
         for mount in mounts:
           if mount['Source'] in bad_dirs and mount['RW'] == True:
@@ -208,7 +419,7 @@ class ContainerRuntimeAudit(Audit):
     badconts = []
     try:
       for container in self.running:
-        processes = self.cli.top(container)['Processes']
+        processes = self.snapshot.top(container)['Processes']
         for process in processes:
           procname = process[7]
         if 'sshd' in procname:
@@ -228,17 +439,17 @@ class ContainerRuntimeAudit(Audit):
     return self.templog
 
   @assign_order(8)
-  def privileged_ports(self,ignore_ports=None):
+  def privileged_ports(self,ignore=None):
     """5.8 Do not map privileged ports within containers"""
     exclude = defaultdict(list)
     bad_mappings = defaultdict(list)
 
-    if ignore_ports != None:
-      for k,v in ignore_ports.iteritems():
+    if ignore != None:
+      for k,v in ignore.iteritems():
         exclude[k].append(v)
 
       for cont in self.running:
-        info = self.cli.inspect_container(cont)
+        info = self.snapshot.inspect(cont)
         img_name = info['Config']['Image']
         ports = info['NetworkSettings']['Ports']
         try:
@@ -267,16 +478,16 @@ class ContainerRuntimeAudit(Audit):
     return self.templog
 
   @assign_order(9)
-  def open_ports(self,hostports=None):
+  def open_ports(self,ignore=None):
     """5.9 Open only needed ports on container"""
     exclude = defaultdict(list)
     mappings = defaultdict(list)
-    if hostports != None:
-      for k,v in hostports.iteritems():
+    if ignore != None:
+      for k,v in ignore.iteritems():
         exclude[k].append(v)
     try:
       for cont in self.running:
-        info = self.cli.inspect_container(cont)
+        info = self.snapshot.inspect(cont)
         img_name = info['Config']['Image']
         ports = info['NetworkSettings']['Ports']
         for port in ports.keys():
@@ -301,101 +512,23 @@ class ContainerRuntimeAudit(Audit):
   @assign_order(10)
   def host_network_mode(self):
     """5.10 Do not use host network mode on container"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        hostmode = self.check_inspect_value('host', info,\
-                                            'HostConfig','NetworkMode')
-        if hostmode == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s)' networking is not containerized"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers are inside a seperate network stack"
-
-    return self.templog
+    return self.rule_results('host_network_mode')
 
   @assign_order(11)
   def memory_usage_limit(self):
     """5.11 Limit memory usage for container"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        nolimit = self.check_inspect_value(0, info, 'HostConfig','Memory')
-        if nolimit == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) have no memory limits"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers have memory limits in place"
-
-    return self.templog
+    return self.rule_results('memory_usage_limit')
 
   @assign_order(12)
   #1024 also means no shares.SHOULD FIX
   def cpu_priority(self):
     """5.12 Set container CPU priority appropriately"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        noshares = self.check_inspect_value(0, info, 'HostConfig','CpuShares')
-        if noshares == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) have no CPU shares set"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers have CPU shares in place"
-
-    #return self.add_check_results('cpu_priority')
-    return self.templog
+    return self.rule_results('cpu_priority')
 
   @assign_order(13)
   def readonly_root_fs(self):
     """5.13 Mount container's root filesystem as read-only"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        noreadonly = self.check_inspect_value(False, info, \
-                                              'HostConfig','ReadonlyRootfs')
-        if noreadonly == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) have writable root FS"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers have read-only root FS"
-    return self.templog
+    return self.rule_results('readonly_root_fs')
 
   @assign_order(14)
   def bind_host_interface(self):
@@ -403,7 +536,7 @@ class ContainerRuntimeAudit(Audit):
     bad_interface = defaultdict(list)
 
     for cont in self.running:
-      info = self.cli.inspect_container(cont)
+      info = self.snapshot.inspect(cont)
       contimg = info['Image']
       ports = info['NetworkSettings']['Ports']
       try:
@@ -435,7 +568,7 @@ class ContainerRuntimeAudit(Audit):
     badconts = []
     try:
       for container in self.running:
-        info = self.cli.inspect_container(container)
+        info = self.snapshot.inspect(container)
         restartpol = info['HostConfig']['RestartPolicy']['Name']
         if restartpol == 'always':
           badconts.append(container)
@@ -459,50 +592,12 @@ class ContainerRuntimeAudit(Audit):
   @assign_order(16)
   def host_process_namespace(self):
     """5.16 Do not share the host's process namespace"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        hostproc = self.check_inspect_value('host', info, \
-                                              'HostConfig','PidMode')
-        if hostproc == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) share host's process namespace"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers' process namespace is isolated"
-    return self.templog
+    return self.rule_results('host_process_namespace')
 
   @assign_order(17)
   def host_ipc_namespace(self):
     """5.17 Do not share the host's IPC namespace"""
-    badconts = []
-    try:
-      for container in self.running:
-        info = self.cli.inspect_container(container)
-        hostipc = self.check_inspect_value('host', info, \
-                                              'HostConfig','IpcMode')
-        if hostipc == True:
-          badconts.append(container)
-    except TypeError:
-      return None
-
-    if len(badconts):
-      self.templog['status'] = 'Fail'
-      self.templog['descr'] = "%d container(s) share host's process namespace"\
-                              %len(badconts)
-      self.templog['output'] = badconts
-    else:
-      self.templog['status'] = 'Pass'
-      self.templog['descr'] = "All containers' process namespace is isolated"
-    return self.templog
+    return self.rule_results('host_ipc_namespace')
 
   @assign_order(18)
   def expose_host_devices(self):
@@ -510,7 +605,7 @@ class ContainerRuntimeAudit(Audit):
     containers_exposed = defaultdict(list)
     try:
       for container in self.running:
-        info = self.cli.inspect_container(container)
+        info = self.snapshot.inspect(container)
         devices = info['HostConfig']['Devices']
         if devices:
           containers_exposed[container] = devices
@@ -1,24 +1,64 @@
 import os
 import stat
-import psutil
 import logging
+from collections import OrderedDict
 from audit import Audit
-from pwd import getpwnam, getpwuid 
-from grp import getgrnam, getgrgid 
+from files import FileTable, TreeWalker, MAX_FILES, WALK_WORKERS
+from pwd import getpwnam
+from grp import getgrnam
 from utils.decorators import assign_order
 
+# Offending files listed in the output of a check, the others are counted
+MAX_REPORTED = 100
+
+
+class Violations(object):
+  """
+  Offending files found by a check. All of them are counted, only the
+  first MAX_REPORTED are kept for the output. The roots of a check are
+  walked without overlapping, so each file is found once.
+  """
+
+  def __init__(self, limit=MAX_REPORTED):
+    self.limit = limit
+    self.count = 0
+    self.found = {}
+
+  def add(self, fpath, detail=None):
+    self.count += 1
+    if len(self.found) < self.limit:
+      self.found[fpath] = detail
+
+  def describe(self, descr, walker):
+    """Adds what was left out of the output and of the walk to descr"""
+    if self.count > len(self.found):
+      descr += ", first %d listed" %len(self.found)
+    if walker is not None and walker.truncated:
+      descr += ", walk stopped after %d files" %walker.count
+    if walker is not None and walker.depth_reached:
+      descr += ", walk limited to %d level(s)" %walker.max_depth
+    return descr
 
 
 class DockerFileAudit(Audit):
   """
   Checks assosiated with Docker installation files
   """
-  # Enhancement - Identify more strict permissions?Recursive for directories?
+  local = True
+
+  def __init__(self, procs=None, files=None):
+    super(DockerFileAudit, self).__init__(procs)
+    #files caches the stat results and owner names shared by the checks
+    self.files = files or FileTable()
+
+  # Enhancement - Identify more strict permissions?
   @assign_order(1)
-  def check_permissions(self,paths):
+  def check_permissions(self,paths,recursive=False,max_depth=None,
+                        max_files=MAX_FILES,workers=WALK_WORKERS):
     """Check permissions, according to perms for a given file or folder"""
+    bad_files = Violations()
+    walker = self.walker(recursive,max_depth,max_files,workers)
     #Owner permissions dictionary
-    bad_files = []
     usrperms = {"0": 0,
                 "1": stat.S_IXUSR,
                 "2": stat.S_IWUSR,
@@ -48,78 +88,121 @@ class DockerFileAudit(Audit):
                 "6": (stat.S_IROTH & stat.S_IWOTH),
                 "7": stat.S_IRWXO
                 }
-    for fpath,perms in paths.iteritems():
+    masks = {}
+    for pattern,perms in sorted(paths.iteritems()):
       try:
         # Split permission decimal values and OR corresponding 
         #dict. values for final bitmask
-        st = os.stat(fpath).st_mode
-        mask = usrperms[perms[0]] | grpperms[perms[1]] | othperms[perms[2]]
+        masks[pattern] = usrperms[perms[0]] | grpperms[perms[1]] | \
+                         othperms[perms[2]]
       except KeyError:
         logging.error('''Wrong permission value for %s. 
-                      Check your configuration''' %fpath)
+                      Check your configuration''' %pattern)
         continue
-      except OSError:
-        logging.warning("No file or directory found: %s" %fpath)
-        continue
-      if not bool(st & mask):
-        bad_files.append(fpath)
-
-    if len(bad_files):
+    for root, patterns in self.roots(sorted(masks),walker).iteritems():
+      # A root matched by several paths must satisfy all of them
+      rootmasks = [masks[pattern] for pattern in patterns]
+      for fpath, st in self.examine(root,walker):
+        # The permissions of symbolic links are not used
+        if stat.S_ISLNK(st.st_mode):
+          continue
+        if any(not st.st_mode & mask for mask in rootmasks):
+          bad_files.add(fpath)
+
+    if bad_files.count:
       self.templog['status'] = "Fail"
-      self.templog['descr'] = "%d file(s) with wrong permissions"\
-                              %len(bad_files)
-      self.templog['output'] = bad_files
+      self.templog['descr'] = bad_files.describe(
+        "%d file(s) with wrong permissions" %bad_files.count, walker)
+      self.templog['output'] = sorted(bad_files.found)
     else:
       self.templog['status'] = "Pass"
-      self.templog['descr'] = "All files have appropriate permissions"
+      self.templog['descr'] = bad_files.describe(
+        "All files have appropriate permissions", walker)
     
     #self.add_check_results('check_permissions')
     return self.templog
 
-  #Enhancement - If path is directory, do the check recursively
   @assign_order(2)
-  def check_owner(self,paths,owner):
+  def check_owner(self,paths,user,recursive=False,max_depth=None,
+                  max_files=MAX_FILES,workers=WALK_WORKERS):
     """Check file user and group owner."""
-    bad_files = []
+    bad_files = Violations()
+    walker = self.walker(recursive,max_depth,max_files,workers)
     # Get uid and gid for given user
-    usruid = getpwnam(owner)[2]
-    grpuid = getgrnam(owner)[2]
-    for fpath in paths:
-      try:
-        st = os.stat(fpath)
-      except OSError:
-        logging.warning("No file or directory found: %s"% fpath)
-        continue
-      #Get uid and gid for given file
-      fileuid = st.st_uid
-      filegid = st.st_uid
-      fileusr = getpwuid(fileuid)[0]
-      filegrp = getgrgid(fileuid)[0]
-
-      if not (fileuid == usruid and grpuid == filegid):
-        bad_files.append(fpath)
-
-    if len(bad_files):
+    usruid = getpwnam(user)[2]
+    grpuid = getgrnam(user)[2]
+    for root in self.roots(paths,walker):
+      for fpath, st in self.examine(root,walker):
+        if not (st.st_uid == usruid and st.st_gid == grpuid):
+          # Report the current owners, resolving each id once
+          bad_files.add(fpath, "%s:%s" %(self.files.user(st.st_uid),
+                                         self.files.group(st.st_gid)))
+
+    if bad_files.count:
       self.templog['status'] = "Fail"
-      self.templog['descr'] = "The following files should be owned by %s:%s"\
-                              %(owner,owner)
-      self.templog['output'] = bad_files
+      self.templog['descr'] = bad_files.describe(
+        "%d file(s) should be owned by %s:%s" %(bad_files.count,user,user),
+        walker)
+      self.templog['output'] = bad_files.found
     else:
       self.templog['status'] = "Pass"
-      self.templog['descr'] = "File user and group owner are correct"
+      self.templog['descr'] = bad_files.describe(
+        "File user and group owner are correct", walker)
 
     #self.add_check_results('check_owner')
     return self.templog
 
+  def walker(self,recursive,max_depth,max_files,workers):
+    """Returns the walker of a recursive check, or None"""
+    if not recursive:
+      return None
+    return TreeWalker(max_depth, max_files, workers)
+
+  def roots(self,patterns,walker=None):
+    """
+    Returns the files matching profile paths, each once, with the paths
+    matching them. A walk does not enter the other roots below it, they
+    are walked on their own, so no file is examined twice and the most
+    specific profile path applies to the files below it.
+    """
+    found = OrderedDict()
+    for pattern in patterns:
+      for fpath in self.existing_files(pattern):
+        found.setdefault(os.path.normpath(fpath), []).append(pattern)
+    if walker is not None:
+      walker.skip = set(found)
+    return found
+
+  def examine(self,root,walker=None):
+    """
+    Yields a root with its stat result. With a walker, directories are
+    walked and the entries below them are yielded as they are listed,
+    without being cached.
+    """
+    if walker is None:
+      yield root, self.files.stat(root)
+    else:
+      for entry in walker.walk(root, self.files.stat(root)):
+        yield entry
+
+  def existing_files(self,pattern):
+    """Returns the files matching a profile path which exist"""
+    found = [fpath for fpath in self.files.expand(pattern) \
+             if self.files.stat(fpath) is not None]
+    if not found:
+      logging.warning("No file or directory found: %s" %pattern)
+    return found
+
 class DockerConfAudit(Audit):
   """Checks assosiated with Docker server configuration"""
+  local = True
 
   @assign_order(1)
   def check_unwanted_args(self,args):
     """Generic method to detect insecure arguments for running docker"""
     found =[]
 
-    cmd = self.process_running('docker')
+    cmd = self.docker_running()
     try:
       for arg in args:
         if (arg in cmd):
@@ -144,7 +227,7 @@ class DockerConfAudit(Audit):
     """Generic method to detect missing security-hardening arguments"""
     missing =[]
 
-    cmd = self.process_running('docker')
+    cmd = self.docker_running()
     try:
       for arg in args:
         if not (arg in cmd):
@@ -0,0 +1,214 @@
+import os
+import glob
+from stat import S_ISDIR
+import logging
+import itertools
+from operator import itemgetter
+from pwd import getpwuid
+from grp import getgrgid
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Path component matching any number of directories
+RECURSIVE = '**'
+# Walks stop after MAX_FILES entries by default. With more than one
+# worker, directories are listed by a pool of threads, in chunks. Threads
+# only pay off when stat calls wait on storage (cold caches, network
+# filesystems): with cached metadata, a single thread is faster.
+WALK_WORKERS = 1
+WALK_CHUNKSIZE = 16
+MAX_FILES = 1000000
+
+
+def glob_paths(pattern):
+  """
+  Expands a path pattern, sorted. Besides the patterns of glob, a '**'
+  component matches the directory it is in and all the directories
+  below it, e.g. /etc/docker/certs.d/**/*.pem. Paths without wildcards
+  are returned as they are, whether they exist or not.
+  """
+  if not glob.has_magic(pattern):
+    return [pattern]
+  parts = pattern.split(os.sep)
+  if RECURSIVE not in parts:
+    return sorted(glob.glob(pattern))
+  index = parts.index(RECURSIVE)
+  head = os.sep.join(parts[:index]) or (os.sep if index else os.curdir)
+  tail = os.sep.join(parts[index + 1:])
+  matches = set()
+  for base in glob_paths(head):
+    for root, dirs, files in os.walk(base):
+      if tail:
+        matches.update(glob_paths(os.path.join(root, tail)))
+      else:
+        matches.add(root)
+        matches.update(os.path.join(root, name) for name in files)
+  return sorted(matches)
+
+
+class FileTable(object):
+  """
+  Files examined during a run. Each path is stat'ed once and each path
+  pattern expanded once, whichever check asks first, and owner names
+  are resolved once per uid and gid since lookups may go to NSS
+  services such as LDAP.
+  """
+
+  def __init__(self):
+    self.stats = {}
+    self.patterns = {}
+    self.users = {}
+    self.groups = {}
+
+  def stat(self, path):
+    """Returns the stat result of a path, or None if it does not exist"""
+    try:
+      return self.stats[path]
+    except KeyError:
+      pass
+    try:
+      st = os.stat(path)
+    except OSError:
+      st = None
+    self.stats[path] = st
+    return st
+
+  def expand(self, pattern):
+    """Returns the paths matching a profile path, which may be a pattern"""
+    try:
+      return self.patterns[pattern]
+    except KeyError:
+      pass
+    paths = glob_paths(pattern)
+    if paths != [pattern]:
+      logging.debug("%s matches %d paths" %(pattern, len(paths)))
+    self.patterns[pattern] = paths
+    return paths
+
+  def user(self, uid):
+    """Returns the name of a user id, or the id if it has no name"""
+    try:
+      return self.users[uid]
+    except KeyError:
+      pass
+    try:
+      name = getpwuid(uid)[0]
+    except KeyError:
+      name = str(uid)
+    self.users[uid] = name
+    return name
+
+  def group(self, gid):
+    """Returns the name of a group id, or the id if it has no name"""
+    try:
+      return self.groups[gid]
+    except KeyError:
+      pass
+    try:
+      name = getgrgid(gid)[0]
+    except KeyError:
+      name = str(gid)
+    self.groups[gid] = name
+    return name
+
+
+def scan_dir(path):
+  """
+  Returns the entries of a directory with their lstat results, sorted
+  by path. Uses scandir when it is available. Entries which vanish while
+  the directory is listed are left out.
+  """
+  entries = []
+  try:
+    if scandir is not None:
+      for entry in scandir(path):
+        try:
+          entries.append((entry.path, entry.stat(follow_symlinks=False)))
+        except OSError:
+          continue
+    else:
+      prefix = os.path.join(path, '')
+      lstat = os.lstat
+      for name in os.listdir(path):
+        try:
+          entries.append((prefix + name, lstat(prefix + name)))
+        except OSError:
+          continue
+  except OSError as e:
+    logging.debug("Unable to list %s: %s" %(path, e))
+  entries.sort(key=itemgetter(0))
+  return entries
+
+
+class TreeWalker(object):
+  """
+  Walks directory trees breadth first, listing the directories of each
+  level with a pool of workers. Entries are yielded as soon as their
+  directory is listed, in a stable order, so no tree is held in memory. Symbolic
+  links are not followed and other filesystems (e.g. container root
+  filesystems mounted under /var/lib/docker) are not entered. A walker
+  stops max_depth levels below each root, and after max_files entries
+  over all the roots it walks.
+  """
+
+  def __init__(self, max_depth=None, max_files=MAX_FILES,
+               workers=WALK_WORKERS):
+    self.max_depth = max_depth
+    self.max_files = max_files
+    self.workers = workers
+    self.count = 0
+    self.truncated = False
+    #set when max_depth leaves directories unlisted
+    self.depth_reached = False
+    #paths which are not entered, e.g. the roots of other walks
+    self.skip = set()
+
+  def walk(self, root, st):
+    """Yields (path, stat result) of root, given its stat, and below it"""
+    if self.max_files is not None and self.count >= self.max_files:
+      self.truncated = True
+      return
+    self.count += 1
+    yield root, st
+    level = [root] if S_ISDIR(st.st_mode) else []
+    depth = 0
+    pool = None
+    try:
+      while level and (self.max_depth is None or depth < self.max_depth):
+        if pool is None and self.workers > 1:
+          from multiprocessing.pool import ThreadPool
+          pool = ThreadPool(self.workers)
+        if pool is not None:
+          listings = pool.imap(scan_dir, level, WALK_CHUNKSIZE)
+        else:
+          listings = itertools.imap(scan_dir, level)
+        subdirs = []
+        for entries in listings:
+          if self.skip:
+            entries = [entry for entry in entries \
+                       if entry[0] not in self.skip]
+          if self.max_files is not None and \
+             self.count + len(entries) > self.max_files:
+            entries = entries[:self.max_files - self.count]
+            self.truncated = True
+          self.count += len(entries)
+          for fpath, entry_st in entries:
+            yield fpath, entry_st
+            if S_ISDIR(entry_st.st_mode) and \
+               entry_st.st_dev == st.st_dev:
+              subdirs.append(fpath)
+          if self.truncated:
+            return
+        level = subdirs
+        depth += 1
+      if level:
+        self.depth_reached = True
+    finally:
+      if pool is not None:
+        pool.terminate()
@@ -1,29 +1,29 @@
 import os
-import re
-import psutil
 import subprocess
 import logging
 
 from utils.decorators import assign_order
 from grp import getgrnam
-from audit import Audit
-from docker import Client,tls
+from audit import Audit, BASE_URL
+import auditd
+import listeners
+from session import DockerSession
 
 
 class HostConfAudit(Audit):
+  local_audits = ('check_seperate_partition', 'check_listening_srv',
+                  'list_trusted_users', 'check_auditd_rules')
 
-  def __init__(self,url='unix://var/run/docker.sock', cert=None, key=None):
-    super(HostConfAudit, self).__init__()
-    if cert and key:
-      tls_config = tls.TLSConfig(verify=False, assert_hostname = False,\
-                                        client_cert = (cert, key))
-      self.cli = Client(base_url = url, tls = tls_config)
-    else:
-      self.cli = Client(base_url = url)
+  def __init__(self,url=BASE_URL, cert=None, key=None, session=None,
+               procs=None):
+    super(HostConfAudit, self).__init__(procs)
+    self.session = session or DockerSession(url, cert, key)
+    self.cli = self.session.cli
 
   @assign_order(1)
   def check_seperate_partition(self):
     """1.1 Create a seperate partition for containers"""    
+    import psutil
     mountpoint = "/var/lib/docker"
     partitions = psutil.disk_partitions()
     for partition in partitions:
@@ -37,45 +37,79 @@ class HostConfAudit(Audit):
     return self.templog
 
   @assign_order(2)
-  def check_kernel_ver(self,ver):
+  def check_kernel_ver(self,version):
     """1.2 Use the updated kernel version"""
-    version = self.cli.version()['KernelVersion']
-    isupdate = self.version_check(version,ver)
+    kernel = self.session.version()['KernelVersion']
+    isupdate = self.version_check(kernel,version)
     if isupdate:
       self.templog['status'] = "Pass"
       self.templog['descr'] =  "Host uses an updated kernel"
     else:
       self.templog['status'] = "Fail"
       self.templog['descr'] =  "Host uses an outdated kernel"
-    self.templog['output'] = version
+    self.templog['output'] = kernel
     return self.templog
 
-#Enhancement - Add a list of essential ports
   @assign_order(3)
-  def check_listening_srv(self):
+  def check_listening_srv(self,essential=None,pids=False):
     """1.5 Remove all non-essential services from the host"""
-    openports= []
-    conns = psutil.net_connections()
-    for con in conns:
-      if (con[5] == 'LISTEN'):
-        openports.append([con[3][0],con[3][1]])
-    self.templog['descr'] = "Host has %d open ports" %(len(openports))
-    self.templog['output'] = openports
+    if os.path.exists(os.path.join(listeners.PROC_NET, 'tcp')):
+      socks = listeners.listeners()
+    else:
+      socks = self.psutil_listeners()
+    openports = socks
+    if essential is not None:
+      # Ports are allowed on any protocol, or on one as in "53/udp"
+      essential = set(str(port) for port in essential)
+      openports = [sock for sock in socks if not (str(sock[1]) in essential \
+                   or "%d/%s" %(sock[1], sock[2]) in essential)]
+      if openports:
+        self.templog['status'] = "Fail"
+        self.templog['descr'] = "%d out of %d open ports are not essential"\
+                                %(len(openports),len(socks))
+      else:
+        self.templog['status'] = "Pass"
+        self.templog['descr'] = "Host has %d open ports, all essential"\
+                                %(len(socks))
+    else:
+      self.templog['descr'] = "Host has %d open ports" %(len(socks))
+
+    owners = {}
+    if pids:
+      # Only the reported sockets are looked up in the processes' files
+      owners = listeners.socket_owners([sock[3] for sock in openports \
+                                        if sock[3] is not None])
+    output = []
+    for ip, port, proto, inode in openports:
+      if pids:
+        pid, name = owners.get(inode, (None, None))
+        output.append([ip, port, proto, pid, name])
+      else:
+        output.append([ip, port, proto])
+    self.templog['output'] = output
     return self.templog
 
+  def psutil_listeners(self):
+    """Listening TCP sockets, where /proc/net is not available"""
+    import psutil
+    socks = set()
+    for con in psutil.net_connections('tcp'):
+      if (con[5] == 'LISTEN'):
+        socks.add((con[3][0], con[3][1], 'tcp', None))
+    return sorted(socks)
+
   @assign_order(4)
-  def check_docker_ver(self,ver):
+  def check_docker_ver(self,version):
     """1.6 Keep Docker up to date"""
-    cli = self.cli
-    version = cli.version()['Version']
-    isupdate = self.version_check(version,ver)
+    docker = self.session.version()['Version']
+    isupdate = self.version_check(docker,version)
     if isupdate:
       self.templog['status'] = "Pass"
       self.templog['descr'] =  "Host uses an updated Docker version"
     else:
       self.templog['status'] = "Fail"
       self.templog['descr'] =  "Host uses an outdated Docker version"
-    self.templog['output'] = version
+    self.templog['output'] = docker
     return self.templog
 
 #Enhancement - Add a list of trusted users
@@ -89,29 +123,51 @@ class HostConfAudit(Audit):
     return self.templog
 
   @assign_order(6)
-  def check_auditd_rules(self,rules):
+  def check_auditd_rules(self,paths,perms="wa",rules_dir=None):
     """1.8 - 1.19 Audit docker daemon, files and directories"""
-    found = []
+    found = {}
     missing = []
+    insufficient = {}
     results = {'found': found,
-             'missing' : missing}
-    try:
-      auditcmd = subprocess.check_output("auditctl -l", shell=True)
-      for rule in rules:
-        if  (re.search(rule, auditcmd)):
-          found.append(rule)
-        else:
-          missing.append(rule)
-    except subprocess.CalledProcessError:
-      logging.error("auditd is not installed. REMINDER: \
-                    safedock should be run as root")
+               'missing' : missing,
+               'insufficient': insufficient}
+    rules = self.auditd_rules(rules_dir)
+    for path in paths:
+      # Permissions of the watch, e.g. "wa"
+      watched = rules.perms(path)
+      if watched is None:
+        missing.append(path)
+      elif set(perms) - set(watched):
+        insufficient[path] = watched
+      else:
+        found[path] = watched
 
-    if len(missing) > 0:
+    if len(missing) > 0 or len(insufficient) > 0:
         self.templog['status'] = "Fail"
         self.templog['descr'] = "%d out of %d auditd rules are missing" \
-                                %(len(missing),len(rules)) 
+                                %(len(missing),len(paths))
+        if insufficient:
+          self.templog['descr'] += ", %d do not watch '%s' access" \
+                                   %(len(insufficient),perms)
     else:
       self.templog['status'] = "Pass"
       self.templog['descr'] = "All auditd rules are in place"      
     self.templog['output'] = results
-    return self.templog
\ No newline at end of file
+    return self.templog
+
+  def auditd_rules(self,rules_dir=None):
+    """
+    Returns the auditd rules loaded in the kernel, or the rules files of
+    rules_dir when given or when the loaded rules cannot be listed.
+    """
+    if rules_dir is None:
+      try:
+        return auditd.loaded_rules()
+      except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Unable to list auditd rules (%s), reading %s" \
+                        %(e, auditd.RULES_DIR))
+        rules_dir = auditd.RULES_DIR
+    if not os.path.isdir(rules_dir):
+      logging.error("auditd is not installed. REMINDER: \
+                    drydock should be run as root")
+    return auditd.rule_files(rules_dir)
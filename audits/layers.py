@@ -0,0 +1,338 @@
+import os
+import re
+import json
+import stat
+import fnmatch
+import hashlib
+import logging
+import posixpath
+
+import stats
+
+# Bumped whenever the findings of a layer change meaning
+SCAN_VERSION = 2
+# Images streamed from the daemon at the same time
+IMAGE_WORKERS = 4
+# Findings kept per kind and layer, the others are counted
+MAX_FINDINGS = 100
+KINDS = ('setuid', 'setgid', 'world_writable', 'secrets')
+# Names of files holding credentials, matched against the file name, or
+# against the end of the path for patterns with a directory
+SECRET_FILES = ['id_rsa', 'id_dsa', 'id_ecdsa', 'id_ed25519', '*.key',
+                '*.p12', '*.pfx', '.netrc', '.pgpass', '.git-credentials',
+                '.npmrc', '.pypirc', '.dockercfg', '.docker/config.json',
+                '.aws/credentials', '.ssh/authorized_keys']
+WHITEOUT = '.wh.'
+# Layers of OCI layout archives (docker save since Docker 25) are blobs
+# named by their digest, which is their diff ID as they are not compressed
+BLOBS = 'blobs/sha256/'
+OPAQUE = '.wh..wh..opq'
+READ_SIZE = 65536
+
+
+def secrets_matcher(patterns):
+  """Returns a function telling if a path names a secrets file"""
+  names = [fnmatch.translate(p) for p in patterns if '/' not in p]
+  paths = [fnmatch.translate('*/' + p) for p in patterns if '/' in p]
+  name_re = re.compile('|'.join(names)) if names else None
+  path_re = re.compile('|'.join(paths)) if paths else None
+  def matches(path):
+    if name_re and name_re.match(posixpath.basename(path)):
+      return True
+    return bool(path_re and path_re.match(path))
+  return matches
+
+
+class HashingReader(object):
+  """Reads a file object, hashing everything read"""
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.sha = hashlib.sha256()
+
+  def read(self, size=-1):
+    data = self.fileobj.read(size)
+    self.sha.update(data)
+    return data
+
+  def digest(self):
+    """Reads what is left and returns the sha256 digest of the file"""
+    while self.read(READ_SIZE):
+      pass
+    return 'sha256:' + self.sha.hexdigest()
+
+
+def scan_layer(fileobj, is_secret):
+  """
+  Reads the tar headers of a layer as it streams, without extracting
+  anything, and returns its digest (the diff ID of the layer) and its
+  findings. Whiteouts, which delete files of lower layers, are recorded
+  so that findings of the lower layers can be dropped. Findings over
+  MAX_FINDINGS per kind are only counted, in findings['truncated'].
+  """
+  import tarfile
+  reader = HashingReader(fileobj)
+  findings = dict((kind, []) for kind in KINDS)
+  counts = dict((kind, 0) for kind in KINDS)
+  whiteouts = []
+
+  def add(kind, path):
+    counts[kind] += 1
+    if len(findings[kind]) < MAX_FINDINGS:
+      findings[kind].append(path)
+
+  layer = tarfile.open(fileobj=reader, mode='r|')
+  while True:
+    member = layer.next()
+    if member is None:
+      break
+    # Stream mode keeps every header otherwise
+    layer.members = []
+    name = member.name[2:] if member.name.startswith('./') else member.name
+    path = '/' + name.rstrip('/')
+    base = posixpath.basename(path)
+    if base.startswith(WHITEOUT):
+      parent = posixpath.dirname(path)
+      if base == OPAQUE:
+        whiteouts.append(parent.rstrip('/') + '/')
+      else:
+        whiteouts.append(posixpath.join(parent, base[len(WHITEOUT):]))
+      continue
+    if member.issym() or member.islnk():
+      continue
+    mode = member.mode
+    if member.isreg():
+      if mode & stat.S_ISUID:
+        add('setuid', path)
+      if mode & stat.S_ISGID:
+        add('setgid', path)
+      if is_secret(path):
+        add('secrets', path)
+    # Shared directories such as /tmp are protected by the sticky bit
+    if mode & stat.S_IWOTH and not (member.isdir() and mode & stat.S_ISVTX):
+      add('world_writable', path)
+  layer.close()
+  findings['truncated'] = dict((kind, counts[kind] - MAX_FINDINGS) \
+                               for kind in KINDS if counts[kind] > MAX_FINDINGS)
+  findings['whiteouts'] = whiteouts
+  return reader.digest(), findings
+
+
+def diff_ids(info):
+  """Returns the diff IDs of the layers of an image, from the lowest"""
+  return (info.get('RootFS') or {}).get('Layers') or []
+
+
+def merge_layers(layers):
+  """
+  Combines the findings of the layers of an image, from the lowest,
+  dropping files deleted by a higher layer. Returns the findings of
+  each kind, with the number of findings left out by kind in
+  'truncated', or None if there are none.
+  """
+  merged = dict((kind, []) for kind in KINDS)
+  truncated = {}
+  for index, layer in enumerate(layers):
+    deleted = [w for upper in layers[index + 1:] for w in upper['whiteouts']]
+    for kind in KINDS:
+      for path in layer[kind]:
+        if not any(path == w or path.startswith(w.rstrip('/') + '/') \
+                   for w in deleted):
+          merged[kind].append(path)
+    # Files left out are counted even if a higher layer deletes them
+    for kind, count in layer['truncated'].iteritems():
+      truncated[kind] = truncated.get(kind, 0) + count
+  merged = dict((kind, paths) for kind, paths in merged.iteritems() if paths)
+  if truncated:
+    merged['truncated'] = truncated
+  return merged or None
+
+
+def format_findings(findings):
+  """Returns the findings of an image as check output"""
+  output = dict((kind, list(findings[kind])) for kind in KINDS \
+                if kind in findings)
+  for kind, count in (findings.get('truncated') or {}).iteritems():
+    output.setdefault(kind, []).append("... %d more" %count)
+  if 'not_scanned' in findings:
+    output['not_scanned'] = findings['not_scanned']
+  return output
+
+
+class LayerCache(object):
+  """
+  Findings of image layers by diff ID. Layers never change, so they are
+  scanned once however many images share them, and, with a path, kept
+  in a JSON file between runs.
+  """
+
+  def __init__(self, path=None):
+    self.path = path
+    self.entries = {}
+    self.changed = False
+    if path is None:
+      return
+    try:
+      with open(path) as f:
+        cache = json.load(f)
+      if cache.get('version') == SCAN_VERSION:
+        self.entries = cache['layers']
+    except IOError:
+      logging.debug("No layer cache found at %s" %path)
+    except (ValueError, KeyError, AttributeError):
+      logging.warning("Ignoring invalid layer cache %s" %path)
+
+  def key(self, diff_id, patterns):
+    digest = hashlib.sha1(json.dumps(sorted(patterns))).hexdigest()[:12]
+    return "%s:%s" %(diff_id, digest)
+
+  def get(self, key):
+    return self.entries.get(key)
+
+  def put(self, key, findings):
+    self.entries[key] = findings
+    self.changed = True
+
+  def save(self):
+    if self.path is None or not self.changed:
+      return
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump({'version': SCAN_VERSION, 'layers': self.entries}, f)
+      os.rename(tmp, self.path)
+    except (IOError, OSError) as e:
+      logging.error("Unable to save layer cache %s: %s" %(self.path, e))
+
+
+class ImageScanner(object):
+  """
+  Scans the filesystems of images for setuid and setgid files, world
+  writable paths and files holding secrets. Images are streamed from the
+  daemon as docker save archives and read one tar header at a time, so
+  memory does not grow with image size. Images whose layers were all
+  scanned before are not downloaded. The findings of images which were
+  not scanned in full have the reason in 'not_scanned'.
+  """
+
+  def __init__(self, cli, cache, patterns=SECRET_FILES,
+               workers=IMAGE_WORKERS):
+    self.cli = cli
+    self.cache = cache
+    self.patterns = patterns
+    self.is_secret = secrets_matcher(patterns)
+    self.workers = workers
+
+  def scan(self, images):
+    """
+    Scans images, given as {image ID: inspect document}, and returns
+    their findings by image ID. Images bringing layers which were not
+    scanned yet are streamed in parallel, the others are then made of
+    cached layers only.
+    """
+    streamed = []
+    covered = set()
+    # Larger images first, as they cover the layers of smaller ones
+    for image, info in sorted(images.iteritems(),
+                              key=lambda item: -len(diff_ids(item[1]))):
+      missing = set(diff_id for diff_id in diff_ids(info) \
+                    if self.cache.get(self.key(diff_id)) is None)
+      if not diff_ids(info) or missing - covered:
+        streamed.append((image, info))
+        covered |= missing
+    workers = min(self.workers, len(streamed))
+    if workers > 1:
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(workers)
+      try:
+        results = pool.map(stats.bind(self.scan_image), streamed)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = map(self.scan_image, streamed)
+    findings = dict((image, res) for (image, _), res in zip(streamed, results))
+    for image, info in images.iteritems():
+      if image not in findings:
+        findings[image] = self.scan_image((image, info))
+    return findings
+
+  def key(self, diff_id):
+    return self.cache.key(diff_id, self.patterns)
+
+  def scan_image(self, job):
+    image, info = job
+    layer_ids = diff_ids(info)
+    layers = [self.cache.get(self.key(diff_id)) for diff_id in layer_ids]
+    if layer_ids and None not in layers:
+      logging.debug("Layers of %s were already scanned" %image)
+      return merge_layers(layers)
+    try:
+      scanned, order = self.stream(image, layer_ids)
+    except Exception as e:
+      logging.warning("Unable to scan image %s: %s" %(image, e))
+      return {'not_scanned': "Unable to read the image: %s" %e}
+    for diff_id, findings in scanned.iteritems():
+      self.cache.put(self.key(diff_id), findings)
+    # Layers from the lowest, as listed by the daemon or the archive
+    layer_ids = layer_ids or [diff_id for diff_id in order if diff_id]
+    missing = [diff_id for diff_id in layer_ids if diff_id not in scanned]
+    findings = merge_layers([scanned[diff_id] for diff_id in layer_ids \
+                             if diff_id in scanned])
+    if layer_ids and not missing:
+      return findings
+    if layer_ids:
+      reason = "%d of %d layer(s) not found in the image archive" \
+               %(len(missing), len(layer_ids))
+    else:
+      reason = "No layers found in the image archive"
+    logging.warning("Image %s not scanned in full: %s" %(image, reason))
+    findings = findings or {}
+    findings['not_scanned'] = reason
+    return findings
+
+  def stream(self, image, expected=()):
+    """
+    Reads the docker save archive of an image and scans its layers.
+    Returns the findings by diff ID and the diff IDs in the order of
+    the archive's manifest. Layers are the layer.tar files of legacy
+    archives and, in the OCI layout, the blobs whose digest is one of
+    the expected diff IDs. The manifest comes after the blobs, so
+    without expected diff IDs every blob is read as a layer.
+    """
+    import tarfile
+    logging.debug("Streaming image %s" %image)
+    archive = tarfile.open(fileobj=self.cli.get_image(image), mode='r|')
+    expected = set(expected)
+    scanned = {}
+    layer_ids = {}
+    manifest = []
+    while True:
+      member = archive.next()
+      if member is None:
+        break
+      archive.members = []
+      if member.name.endswith('/layer.tar'):
+        is_layer = True
+      elif member.name.startswith(BLOBS) and member.isfile():
+        digest = 'sha256:' + member.name[len(BLOBS):]
+        is_layer = not expected or digest in expected
+      else:
+        is_layer = False
+      if is_layer:
+        try:
+          diff_id, findings = scan_layer(archive.extractfile(member),
+                                         self.is_secret)
+        except tarfile.TarError:
+          # Image configurations and manifests are blobs too
+          logging.debug("%s of %s is not a layer" %(member.name, image))
+          continue
+        scanned[diff_id] = findings
+        layer_ids[member.name] = diff_id
+      elif member.name == 'manifest.json':
+        manifest = json.load(archive.extractfile(member))
+    archive.close()
+    order = []
+    for entry in manifest[:1]:
+      order = [layer_ids.get(layer) for layer in entry.get('Layers', [])]
+    return scanned, order
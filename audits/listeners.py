@@ -0,0 +1,94 @@
+import os
+import socket
+import struct
+import logging
+
+PROC_NET = '/proc/net'
+# Socket tables and the state of their listening sockets: TCP_LISTEN,
+# and TCP_CLOSE for UDP sockets, which are listening when unconnected
+TABLES = (('tcp', socket.AF_INET, '0A'),
+          ('tcp6', socket.AF_INET6, '0A'),
+          ('udp', socket.AF_INET, '07'),
+          ('udp6', socket.AF_INET6, '07'))
+
+
+def decode_address(address, family):
+  """
+  Decodes an address of /proc/net tables, e.g. 0100007F:0035, into an
+  IP and a port. IPs are written as 32 bit words in host byte order.
+  """
+  ip, port = address.split(':')
+  words = [int(ip[i:i + 8], 16) for i in range(0, len(ip), 8)]
+  packed = struct.pack('=%dI' %len(words), *words)
+  return socket.inet_ntop(family, packed), int(port, 16)
+
+
+def read_table(path, family, state):
+  """Yields the local address and inode of the listening sockets of a table"""
+  with open(path) as f:
+    next(f)
+    for line in f:
+      fields = line.split()
+      if fields[3] != state:
+        continue
+      # Connected UDP sockets have a remote port
+      if state == '07' and not fields[2].endswith(':0000'):
+        continue
+      ip, port = decode_address(fields[1], family)
+      yield ip, port, int(fields[9])
+
+
+def listeners(proc_net=PROC_NET):
+  """
+  Returns the listening sockets of the host as (ip, port, protocol,
+  inode), read from the socket tables of /proc/net. Unlike enumerating
+  the sockets of every process, the cost does not grow with the number
+  of processes and open files. Tables missing from the kernel (e.g.
+  without IPv6) are skipped.
+  """
+  found = set()
+  for table, family, state in TABLES:
+    proto = table.rstrip('6')
+    try:
+      for ip, port, inode in read_table(os.path.join(proc_net, table),
+                                        family, state):
+        found.add((ip, port, proto, inode))
+    except IOError as e:
+      logging.debug("Unable to read %s: %s" %(table, e))
+  return sorted(found)
+
+
+def socket_owners(inodes, proc='/proc'):
+  """
+  Finds the processes holding sockets, as {inode: (pid, name)}. The file
+  descriptors of processes are only read until every socket is found.
+  """
+  wanted = set('socket:[%d]' %inode for inode in inodes)
+  owners = {}
+  for pid in os.listdir(proc):
+    if not wanted:
+      break
+    if not pid.isdigit():
+      continue
+    fd_dir = os.path.join(proc, pid, 'fd')
+    try:
+      fds = os.listdir(fd_dir)
+    except OSError:
+      continue
+    for fd in fds:
+      try:
+        target = os.readlink(os.path.join(fd_dir, fd))
+      except OSError:
+        continue
+      if target in wanted:
+        wanted.discard(target)
+        owners[int(target[8:-1])] = (int(pid), process_name(proc, pid))
+  return owners
+
+
+def process_name(proc, pid):
+  try:
+    with open(os.path.join(proc, pid, 'comm')) as f:
+      return f.read().strip()
+  except IOError:
+    return None
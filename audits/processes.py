@@ -0,0 +1,56 @@
+import os
+import logging
+import threading
+from collections import defaultdict
+
+
+class ProcessTable(object):
+  """
+  Snapshot of the host's process table, taken once per run on first use.
+  Processes are indexed by their name and by the file name of their
+  executable, and carry their command line.
+  """
+
+  def __init__(self):
+    self.byname = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Scans the process table"""
+    import psutil
+    byname = defaultdict(list)
+    for proc in psutil.process_iter():
+      try:
+        info = proc.as_dict(attrs=['pid', 'name', 'exe', 'cmdline'])
+      except psutil.NoSuchProcess:
+        continue
+      names = set([info['name']])
+      if info['exe']:
+        # Replaced executables are reported as '<path> (deleted)'
+        names.add(os.path.basename(info['exe'].split(' (deleted)')[0]))
+      for name in names:
+        if name:
+          byname[name].append(info)
+    logging.debug("Process table holds %d names" %len(byname))
+    self.byname = byname
+
+  def find(self, name):
+    """Returns the processes matching a process or executable name"""
+    with self.lock:
+      if self.byname is None:
+        self.load()
+    return self.byname.get(name, [])
+
+  def docker_daemon(self):
+    """
+    Returns the Docker daemon process. Recent versions run as dockerd,
+    older ones as 'docker daemon' or 'docker -d', so docker client
+    processes are skipped.
+    """
+    for proc in self.find('dockerd'):
+      return proc
+    for proc in self.find('docker'):
+      cmd = proc['cmdline'] or []
+      if 'daemon' in cmd or '-d' in cmd or '--daemon' in cmd:
+        return proc
+    return None
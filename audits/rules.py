@@ -0,0 +1,144 @@
+import json
+import hashlib
+import logging
+from collections import defaultdict
+
+# Markers for inspect values that are not plain values
+MISSING = object()
+SUBTREE = object()
+
+
+class Rule(object):
+  """
+  Declarative container check. A rule names a field of the inspect
+  document, the condition which makes a container fail and the
+  descriptions reported when the check passes or fails.
+  """
+  operators = ('equals', 'not_equals', 'in', 'not_in')
+
+  def __init__(self, name, path, fail_if, passed, failed,
+               descr=None, order=None):
+    if not path:
+      raise ValueError("Rule %s has no field path" %name)
+    if len(fail_if) != 1 or fail_if.keys()[0] not in self.operators:
+      raise ValueError("Rule %s needs one condition out of %s" \
+                       %(name, ', '.join(self.operators)))
+    self.name = name
+    self.path = list(path)
+    (self.operator, self.value), = fail_if.items()
+    self.passed = passed
+    self.failed = failed
+    self.descr = descr or name
+    self.order = order
+
+  @classmethod
+  def from_profile(cls, conf, order=None):
+    """Creates a rule from its definition in a YML profile"""
+    try:
+      path = conf['path']
+      if isinstance(path, basestring):
+        path = path.split('.')
+      return cls(conf['name'], path, conf['fail_if'],
+                 conf.get('pass', "All containers passed %s" %conf['name']),
+                 conf.get('fail', "%d container(s) failed " + conf['name']),
+                 descr=conf.get('descr'), order=conf.get('order', order))
+    except (KeyError, TypeError, AttributeError):
+      raise ValueError("Rule definitions need a name, a path and fail_if")
+
+  def fails(self, value):
+    """Applies the fail condition to the value of the rule's field"""
+    if value is SUBTREE:
+      return False
+    if self.operator == 'equals':
+      return value is not MISSING and value == self.value
+    elif self.operator == 'not_equals':
+      return value is MISSING or value != self.value
+    elif self.operator == 'in':
+      return value is not MISSING and value in self.value
+    else:
+      return value is MISSING or value not in self.value
+
+  def results(self, failing):
+    """Formats the containers failing the rule as check results"""
+    results = {}
+    if len(failing):
+      results['status'] = 'Fail'
+      try:
+        results['descr'] = self.failed %len(failing)
+      except TypeError:
+        results['descr'] = self.failed
+      results['output'] = failing
+    else:
+      results['status'] = 'Pass'
+      results['descr'] = self.passed
+    return results
+
+
+class RuleEngine(object):
+  """
+  Evaluates a set of rules in a single pass over each container.
+  Rules reading fields of the same sub-document (e.g. HostConfig)
+  share the traversal to it, so each document is walked once.
+  """
+
+  def __init__(self, rules):
+    self.rules = rules
+    groups = defaultdict(list)
+    for rule in rules:
+      groups[tuple(rule.path[:-1])].append(rule)
+    self.groups = groups.items()
+    # Rules in the order their values are read
+    self.order = [rule for _, group in self.groups for rule in group]
+    self.digest = hashlib.sha1(json.dumps([[rule.name, rule.path,
+                                            rule.operator, rule.value] \
+                                           for rule in self.order],
+                                          default=repr)).hexdigest()
+
+  def values(self, doc):
+    """Reads the values of all rule fields from an inspect document"""
+    values = []
+    for parent, rules in self.groups:
+      node = doc
+      for key in parent:
+        if not isinstance(node, dict):
+          break
+        node = node.get(key, MISSING)
+      for rule in rules:
+        # Like check_inspect_value, a walk ending early on a plain
+        # value compares that value
+        if isinstance(node, dict):
+          value = node.get(rule.path[-1], MISSING)
+          if isinstance(value, dict):
+            value = SUBTREE
+        else:
+          value = node
+        values.append(value)
+    return values
+
+  def evaluate(self, documents, cache=None):
+    """
+    Takes (container, inspect document) pairs and returns a dict with
+    the failing containers of each rule. With a verdict cache, rules are
+    only applied to containers whose rule fields changed since the
+    cached run.
+    """
+    failing = dict((rule.name, []) for rule in self.rules)
+    hits = 0
+    for cont, doc in documents:
+      values = self.values(doc)
+      failed = None
+      if cache is not None:
+        key = cache.key(cont, self.digest, values)
+        failed = cache.get(key)
+      if failed is None:
+        failed = [rule.name for rule, value in zip(self.order, values) \
+                  if rule.fails(value)]
+        if cache is not None:
+          cache.put(key, failed)
+      else:
+        hits += 1
+      for name in failed:
+        failing[name].append(cont)
+    logging.debug("Evaluated %d rules, %d cached container verdicts" \
+                  %(len(self.rules), hits))
+    return failing
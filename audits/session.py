@@ -0,0 +1,117 @@
+import logging
+import threading
+from docker import Client, tls
+from requests.adapters import HTTPAdapter
+
+import stats
+from audit import BASE_URL
+from snapshot import ContainerSnapshot, DEFAULT_WORKERS
+from verdicts import VerdictCache
+from layers import LayerCache
+
+
+class DockerSession(object):
+  """
+  Connection to a Docker daemon shared by every audit category of a run.
+  Holds a single client with pooled keep-alive connections and caches
+  the daemon information that several categories ask for.
+  """
+
+  def __init__(self, url=BASE_URL, cert=None, key=None,
+               workers=DEFAULT_WORKERS, backend='threads', cache=None):
+    if cert and key:
+      # docker-py only accepts TLS settings for https:// URLs
+      if not url.startswith('https://'):
+        url = 'https://' + url.split('://')[-1]
+      tls_config = tls.TLSConfig(verify=False, assert_hostname = False,\
+                                        client_cert = (cert, key))
+      self.cli = Client(base_url = url, tls = tls_config)
+    else:
+      self.cli = Client(base_url = url)
+    self.url = url
+    self.resize_pools(workers)
+    self.cli.hooks['response'].append(self.count_response)
+    fetcher = None
+    if backend == 'async':
+      from asyncfetch import AsyncFetcher
+      fetcher = AsyncFetcher(url, self.cli.api_version, cert, key,
+                             connections=workers)
+    self.snapshot = ContainerSnapshot(self.cli, workers, fetcher)
+    # Rule verdicts kept from previous runs against this daemon
+    self.verdicts = VerdictCache(cache) if cache else None
+    # Findings of scanned image layers, kept next to the verdicts
+    self.layers = LayerCache(cache + '.layers' if cache else None)
+    self.listing = None
+    self.daemon_version = None
+    self.lock = threading.Lock()
+
+  def resize_pools(self, maxsize):
+    """
+    Keeps up to maxsize idle connections per daemon, so that concurrent
+    requests reuse established (and TLS-negotiated) connections instead
+    of opening new ones.
+    """
+    for adapter in self.cli.adapters.values():
+      if isinstance(adapter, HTTPAdapter):
+        connections = getattr(adapter, '_pool_connections', 1)
+        adapter._pool_maxsize = maxsize
+        adapter.init_poolmanager(connections, maxsize)
+
+  def count_response(self, response, *args, **kwargs):
+    """Counts API calls and received bytes for the running check"""
+    if kwargs.get('stream'):
+      # Streamed bodies are read later by the caller
+      nbytes = int(response.headers.get('Content-Length', 0))
+    else:
+      nbytes = len(response.content)
+    stats.record(nbytes)
+
+  def containers(self):
+    """Lists the running containers once per run"""
+    with self.lock:
+      if self.listing is None:
+        logging.debug("Listing running containers on %s" %self.url)
+        self.listing = self.cli.containers()
+    return self.listing
+
+  def container_started(self, container):
+    """Adds a container which started after the listing"""
+    with self.lock:
+      if self.listing is None:
+        self.listing = []
+      if container not in [cont['Id'] for cont in self.listing]:
+        # The listing is ordered from the most recently created container
+        self.listing.insert(0, {'Id': container})
+    self.snapshot.invalidate(container)
+
+  def container_stopped(self, container):
+    """Removes a container which is no longer running"""
+    with self.lock:
+      if self.listing is not None:
+        self.listing = [cont for cont in self.listing \
+                        if cont['Id'] != container]
+    self.snapshot.invalidate(container)
+
+  def container_images(self):
+    """Returns the image of each inspected container, by tag when known"""
+    images = {}
+    for cont, info in self.snapshot.inspected.items():
+      tags = [tag for tag in (self.snapshot.images.get(info['Image']) or {}) \
+              .get('RepoTags') or [] if tag != '<none>:<none>']
+      images[cont] = tags[0] if tags else info['Config']['Image']
+    return images
+
+  def version(self):
+    """Returns the daemon's version information"""
+    with self.lock:
+      if self.daemon_version is None:
+        self.daemon_version = self.cli.version()
+    return self.daemon_version
+
+  def close(self):
+    """Persists the state kept between runs and closes idle connections"""
+    if self.verdicts is not None:
+      self.verdicts.save()
+    self.layers.save()
+    if self.snapshot.fetcher:
+      self.snapshot.fetcher.close()
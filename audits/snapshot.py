@@ -0,0 +1,155 @@
+import time
+import logging
+import itertools
+import threading
+
+import stats
+
+DEFAULT_WORKERS = 8
+# With a deadline, the async fetcher gets batches of this many documents
+# per connection, and no batch is started after the deadline
+DEADLINE_ROUND = 4
+# Client methods fetching each kind of document
+METHODS = {
+  'inspect': 'inspect_container',
+  'top': 'top',
+  'image': 'inspect_image',
+  'history': 'history',
+  }
+
+
+class ContainerSnapshot(object):
+  """
+  Per-run cache of container documents fetched from the Docker daemon.
+  Every container is inspected (and listed with top) at most once and the
+  result is shared by all checks and audit categories using the snapshot.
+  Images are cached by ID the same way, so containers sharing an image
+  cost a single inspect and history.
+  """
+
+  def __init__(self, cli, workers=DEFAULT_WORKERS, fetcher=None):
+    self.cli = cli
+    self.workers = workers
+    # Optional event-loop fetcher replacing the pool of worker threads
+    self.fetcher = fetcher
+    self.inspected = {}
+    self.processes = {}
+    # Image documents never change for an image ID
+    self.images = {}
+    self.histories = {}
+    self.documents = {'inspect': self.inspected,
+                      'top': self.processes,
+                      'image': self.images,
+                      'history': self.histories}
+    # Serializes prefetches of categories running concurrently
+    self.lock = threading.Lock()
+
+  def get(self, kind, key):
+    try:
+      return self.documents[kind][key]
+    except KeyError:
+      logging.debug("Fetching %s of %s" %(kind, key))
+      doc = getattr(self.cli, METHODS[kind])(key)
+      self.documents[kind][key] = doc
+      return doc
+
+  def inspect(self, container):
+    """Returns the inspect document of a container"""
+    return self.get('inspect', container)
+
+  def top(self, container):
+    """Returns the process list of a container"""
+    return self.get('top', container)
+
+  def image(self, image):
+    """Returns the inspect document of an image"""
+    return self.get('image', image)
+
+  def history(self, image):
+    """Returns the layers of an image with the instructions creating them"""
+    return self.get('history', image)
+
+  def invalidate(self, container):
+    """Drops the documents of a container which changed"""
+    self.inspected.pop(container, None)
+    self.processes.pop(container, None)
+
+  def prefetch(self, containers, top=False, deadline=None):
+    """
+    Fetches the documents of many containers through a bounded pool of
+    workers, so that wall time follows the slowest call instead of the
+    sum of all calls. Failed fetches are not cached; the checks retry
+    them serially and handle errors exactly as without prefetching.
+    Fetches stop at the deadline of a time-budgeted run.
+    """
+    if not containers:
+      return
+    with self.lock:
+      self._prefetch(containers, top, deadline)
+
+  def prefetch_images(self, images, history=False):
+    """Fetches the documents of many images, like prefetch"""
+    if not images:
+      return
+    with self.lock:
+      jobs = [('image', image) for image in images]
+      if history:
+        jobs += [('history', image) for image in images]
+      self._fetch_all(jobs)
+
+  def _prefetch(self, containers, top, deadline=None):
+    jobs = [('inspect', cont) for cont in containers]
+    if top:
+      jobs += [('top', cont) for cont in containers]
+    self._fetch_all(jobs, deadline)
+
+  def _fetch_all(self, jobs, deadline=None):
+    jobs = [job for job in jobs if job[1] not in self.documents[job[0]]]
+    if not jobs:
+      return
+
+    workers = min(self.workers, len(jobs))
+    logging.debug("Prefetching %d documents with %d workers" \
+                  %(len(jobs), workers))
+    pool = None
+    if self.fetcher:
+      # The event loop fetches a batch at a time
+      size = len(jobs) if deadline is None else workers * DEADLINE_ROUND
+      batches = (jobs[i:i + size] for i in range(0, len(jobs), size))
+      results = (zip(batch, self.fetcher.fetch(batch)) for batch in batches)
+      results = (res for batch in results for res in batch)
+    elif workers > 1:
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(workers)
+      # API calls are counted for the check which prefetches
+      results = pool.imap_unordered(stats.bind(self._fetch_job), jobs)
+    else:
+      results = itertools.imap(self._fetch_job, jobs)
+
+    fetched = 0
+    try:
+      for (kind, key), res in results:
+        fetched += 1
+        if res is not None:
+          self.documents[kind][key] = res
+        if deadline is not None and time.time() >= deadline and \
+           fetched < len(jobs):
+          logging.debug("Out of time, %d documents not prefetched" \
+                        %(len(jobs) - fetched))
+          break
+    finally:
+      if pool is not None:
+        # Fetches still queued are dropped at the deadline
+        pool.terminate()
+        pool.join()
+
+  def _fetch_job(self, job):
+    return job, self._fetch(job)
+
+  def _fetch(self, job):
+    kind, key = job
+    try:
+      return getattr(self.cli, METHODS[kind])(key)
+    except Exception as e:
+      logging.debug("Prefetch of %s for %s failed: %s" %(kind, key, e))
+      return None
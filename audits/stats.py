@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import resource
+import threading
+
+# Python 2 lacks the constant, but Linux supports per-thread usage
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                        1 if sys.platform.startswith('linux') else None)
+
+_local = threading.local()
+
+
+def cpu_time():
+  """
+  Returns the CPU time of the calling thread, so that categories running
+  concurrently are not charged for each other. Falls back to the CPU
+  time of the whole process.
+  """
+  if RUSAGE_THREAD is not None:
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+  times = os.times()
+  return times[0] + times[1]
+
+
+def active_meters():
+  """Returns the meters measuring the calling thread"""
+  try:
+    return _local.meters
+  except AttributeError:
+    _local.meters = []
+    return _local.meters
+
+
+def record(nbytes):
+  """Counts a Docker API call on the meters of the calling thread"""
+  for meter in active_meters():
+    meter.add(nbytes)
+
+
+def bind(func):
+  """
+  Wraps a function run by worker threads (e.g. prefetches) so that its
+  API calls are counted on the meters of the thread creating the wrapper.
+  """
+  meters = list(active_meters())
+  def bound(*args):
+    previous = active_meters()
+    _local.meters = meters
+    try:
+      return func(*args)
+    finally:
+      _local.meters = previous
+  return bound
+
+
+class Meter(object):
+  """
+  Measures the wall time, CPU time, Docker API calls and bytes received
+  of the code run in its with block.
+  """
+
+  def __init__(self):
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.calls = 0
+    self.bytes = 0
+    self.lock = threading.Lock()
+
+  def add(self, nbytes):
+    with self.lock:
+      self.calls += 1
+      self.bytes += nbytes
+
+  def __enter__(self):
+    active_meters().append(self)
+    self.started = (time.time(), cpu_time())
+    return self
+
+  def __exit__(self, *exc):
+    wall, cpu = self.started
+    self.wall += time.time() - wall
+    self.cpu += cpu_time() - cpu
+    active_meters().remove(self)
+
+  def as_dict(self):
+    return {'wall': round(self.wall, 4),
+            'cpu': round(self.cpu, 4),
+            'api_calls': self.calls,
+            'bytes': self.bytes,
+            }
@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import logging
+
+from rules import MISSING, SUBTREE
+
+# Bumped whenever the way verdicts are computed changes
+CACHE_VERSION = 1
+
+
+class VerdictCache(object):
+  """
+  Rule verdicts of each container, kept between runs in a JSON file.
+  A verdict is reused only while the container Id, the values of the
+  fields read by the rules and the rule definitions are all unchanged.
+  """
+
+  def __init__(self, path=None):
+    # Without a path, verdicts are only kept in memory
+    self.path = path
+    self.entries = {}
+    self.used = {}
+    if path is None:
+      return
+    try:
+      with open(path) as f:
+        cache = json.load(f)
+      if cache.get('version') == CACHE_VERSION:
+        self.entries = cache['verdicts']
+    except IOError:
+      logging.debug("No verdict cache found at %s" %path)
+    except (ValueError, KeyError, AttributeError):
+      logging.warning("Ignoring invalid verdict cache %s" %path)
+
+  def key(self, container, digest, values):
+    """Fingerprints a container's rule fields under a set of rules"""
+    encoded = []
+    for value in values:
+      if value is MISSING:
+        encoded.append(['missing'])
+      elif value is SUBTREE:
+        encoded.append(['subtree'])
+      else:
+        encoded.append(['value', value])
+    fields = hashlib.sha1(json.dumps(encoded, sort_keys=True,
+                                   default=repr)).hexdigest()
+    return "%s:%s:%s" %(container, digest, fields)
+
+  def get(self, key):
+    failed = self.used.get(key, self.entries.get(key))
+    if failed is not None:
+      self.used[key] = failed
+    return failed
+
+  def put(self, key, failed):
+    self.used[key] = failed
+
+  def save(self):
+    """Stores the verdicts used by this run, dropping stale ones"""
+    if self.path is None:
+      return
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'verdicts': self.used}, f)
+      os.rename(tmp, self.path)
+    except (IOError, OSError) as e:
+      logging.error("Unable to save verdict cache %s: %s" %(self.path, e))
@@ -0,0 +1,146 @@
+"""
+Benchmarks the container audit categories against a fake Docker daemon.
+
+  python -m bench.containers -n 10,1000,10000 -l 1 -r 3
+
+For every container count, a fake daemon is started on a unix socket and
+ContainerImgAudit and ContainerRuntimeAudit run the container checks of
+a profile with a new session per run. Throughput (containers and API
+calls per second) and latency (wall time per run) are reported for each
+category and for the slowest checks.
+"""
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+from audits.containers import ContainerImgAudit, ContainerRuntimeAudit
+from audits.session import DockerSession
+from audits.snapshot import DEFAULT_WORKERS
+from audits.stats import Meter
+from utils.confparse import ConfParse
+
+from bench.fakedaemon import serve, wait_ready
+
+CATEGORIES = [('container_imgs', ContainerImgAudit),
+              ('container_runtime', ContainerRuntimeAudit)]
+SLOWEST = 3
+
+
+def percentile(values, pct):
+  values = sorted(values)
+  index = int(round(pct / 100.0 * (len(values) - 1)))
+  return values[index]
+
+
+def run_once(url, profile, workers, backend):
+  """Audits the fake daemon once and returns the measurements"""
+  session = DockerSession(url=url, workers=workers, backend=backend)
+  runs = {}
+  for cat, auditclass in CATEGORIES:
+    if cat not in profile:
+      continue
+    # The container listing is part of the category's cost
+    with Meter() as meter:
+      audit = auditclass(session=session)
+      audit.run_audits(profile[cat])
+    runs[cat] = {'total': meter.as_dict(), 'checks': dict(audit.timings)}
+  return runs
+
+
+def summarize(containers, runs):
+  """Aggregates the measurements of repeated runs of each category"""
+  summary = {}
+  for cat in runs[0]:
+    walls = [run[cat]['total']['wall'] for run in runs]
+    calls = runs[0][cat]['total']['api_calls']
+    mean = sum(walls) / len(walls)
+    checks = {}
+    for check in runs[0][cat]['checks']:
+      checks[check] = max(run[cat]['checks'][check]['wall'] for run in runs)
+    summary[cat] = {
+      'containers': containers,
+      'runs': len(runs),
+      'mean': round(mean, 4),
+      'p50': percentile(walls, 50),
+      'p95': percentile(walls, 95),
+      'containers_per_sec': round(containers / mean, 1) if mean else None,
+      'api_calls': calls,
+      'calls_per_sec': round(calls / mean, 1) if mean else None,
+      'bytes': runs[0][cat]['total']['bytes'],
+      'slowest': sorted(checks.items(), key=lambda item: -item[1])[:SLOWEST],
+      }
+  return summary
+
+
+def benchmark(containers, latency, profile, workers, backend, repeat):
+  """Runs the container audits against a fake daemon of a given size"""
+  tmpdir = tempfile.mkdtemp(prefix='drydock-bench-')
+  path = os.path.join(tmpdir, 'docker.sock')
+  # The daemon runs in its own process so that it does not compete with
+  # the audits for the interpreter lock
+  daemon = multiprocessing.Process(target=serve,
+                                   args=(path, containers, latency / 1000.0))
+  daemon.daemon = True
+  daemon.start()
+  try:
+    if not wait_ready(path):
+      raise RuntimeError("Fake daemon did not start on %s" %path)
+    runs = [run_once('unix://' + path, profile, workers, backend) \
+            for _ in range(repeat)]
+  finally:
+    daemon.terminate()
+    daemon.join()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  return summarize(containers, runs)
+
+
+def print_results(results):
+  row = '%10s %-18s %8s %8s %8s %12s %10s %10s'
+  print(row %('containers', 'category', 'mean(s)', 'p50(s)', 'p95(s)',
+              'containers/s', 'API calls', 'calls/s'))
+  for summary in results:
+    for cat, res in sorted(summary.iteritems()):
+      print(row %(res['containers'], cat, '%.3f' %res['mean'],
+                  '%.3f' %res['p50'], '%.3f' %res['p95'],
+                  res['containers_per_sec'], res['api_calls'],
+                  res['calls_per_sec']))
+      for check, wall in res['slowest']:
+        print('%10s   %-32s %.3f' %('', check, wall))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Container audit benchmark")
+  parser.add_argument("-n", "--containers", default="10,1000,10000",
+                      help="Comma separated container counts")
+  parser.add_argument("-l", "--latency", type=float, default=0,
+                      help="Latency of each API request, in ms")
+  parser.add_argument("-r", "--repeat", type=int, default=3,
+                      help="Runs per container count")
+  parser.add_argument("-p", "--profile", default="conf/default.yml",
+                      help="Profile with the container checks to run")
+  parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS)
+  parser.add_argument("-b", "--backend", choices=['threads', 'async'],
+                      default='threads')
+  parser.add_argument("-o", "--output", help="Save the results as JSON")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.CRITICAL)
+
+  profile = ConfParse().load_conf(args.profile)
+  results = []
+  for containers in [int(n) for n in args.containers.split(',')]:
+    results.append(benchmark(containers, args.latency, profile,
+                             args.workers, args.backend, args.repeat))
+  print_results(results)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'latency_ms': args.latency, 'workers': args.workers,
+                 'backend': args.backend, 'results': results}, f,
+                sort_keys=True, indent=4, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+  main()
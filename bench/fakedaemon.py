@@ -0,0 +1,395 @@
+"""
+Stand-in for the Docker Engine API on a unix socket. It serves synthetic
+containers, inspect and top documents, and the images they use with
+their docker save archives, for benchmarks, with an optional latency added to every request.
+"""
+import os
+import re
+import json
+import hashlib
+import tarfile
+import threading
+from cStringIO import StringIO
+import time
+import socket
+import urllib
+import SocketServer
+import BaseHTTPServer
+
+VERSION = {
+  'Version': '1.10.3',
+  'ApiVersion': '1.22',
+  'KernelVersion': '4.4.0',
+  'Os': 'linux',
+  'Arch': 'amd64',
+  }
+
+
+def container_id(i):
+  return '%064x' %(i + 1)
+
+
+def image_id(i):
+  return 'sha256:%064x' %(i % 50 + 1)
+
+
+def inspect(i):
+  """
+  Returns the inspect document of container i. Settings vary with i so
+  that every check sees passing and failing containers.
+  """
+  ports = {}
+  bindings = {}
+  if i % 2:
+    ports = {'80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': str(8000 + i)}]}
+    bindings = {'80/tcp': [{'HostIp': '', 'HostPort': str(8000 + i)}]}
+  return {
+    'Id': container_id(i),
+    'Created': '2016-03-01T10:00:00.000000000Z',
+    'Path': '/docker-entrypoint.sh',
+    'Args': ['nginx', '-g', 'daemon off;'],
+    'State': {'Status': 'running', 'Running': True, 'Pid': 10000 + i,
+              'StartedAt': '2016-03-01T10:00:01.000000000Z'},
+    'Image': image_id(i),
+    'Name': '/bench_%d' %i,
+    'RestartCount': 0,
+    'Driver': 'overlay',
+    'MountLabel': '',
+    'ProcessLabel': '',
+    'AppArmorProfile': '' if i % 4 == 0 else 'docker-default',
+    'HostConfig': {
+      'Binds': ['/etc:/host/etc:ro'] if i % 10 == 0 else None,
+      'NetworkMode': 'host' if i % 25 == 0 else 'default',
+      'PortBindings': bindings,
+      'RestartPolicy': {'Name': 'on-failure' if i % 3 else 'always',
+                        'MaximumRetryCount': 5 if i % 3 else 0},
+      'CapAdd': ['NET_ADMIN'] if i % 20 == 0 else None,
+      'CapDrop': None,
+      'Privileged': i % 50 == 0,
+      'PidMode': 'host' if i % 40 == 0 else '',
+      'IpcMode': '',
+      'ReadonlyRootfs': i % 2 == 0,
+      'SecurityOpt': None if i % 5 else ['label:type:svirt_apache_t'],
+      'Memory': 0 if i % 3 == 0 else 268435456,
+      'CpuShares': 0 if i % 3 == 0 else 512,
+      'Devices': [{'PathOnHost': '/dev/fuse', 'PathInContainer': '/dev/fuse',
+                   'CgroupPermissions': 'rwm'}] if i % 30 == 0 else [],
+      'LogConfig': {'Type': 'json-file', 'Config': {}},
+      },
+    'Mounts': [{'Source': '/etc', 'Destination': '/host/etc', 'Mode': 'ro',
+                'RW': i % 20 == 0}] if i % 10 == 0 else [],
+    'Config': {
+      'Hostname': container_id(i)[:12],
+      'User': '' if i % 2 else 'nginx',
+      'ExposedPorts': {'80/tcp': {}},
+      'Env': ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin',
+              'NGINX_VERSION=1.9.12-1~jessie'],
+      'Cmd': ['nginx', '-g', 'daemon off;'],
+      'Image': 'bench/image%d' %(i % 50),
+      'Labels': {'com.example.bench': str(i)},
+      },
+    'NetworkSettings': {
+      'IPAddress': '172.17.%d.%d' %(i // 250, i % 250 + 2),
+      'Ports': ports,
+      },
+    }
+
+
+_layers = {}
+_layers_lock = threading.Lock()
+
+
+def tar(entries):
+  """
+  Builds a tar archive of (name, mode, data) entries, where directories
+  have no data. Archives are reproducible, like image layers.
+  """
+  buf = StringIO()
+  archive = tarfile.open(fileobj=buf, mode='w', format=tarfile.USTAR_FORMAT)
+  for name, mode, data in entries:
+    info = tarfile.TarInfo(name)
+    info.mode = mode
+    info.mtime = 0
+    if data is None:
+      info.type = tarfile.DIRTYPE
+      archive.addfile(info)
+    else:
+      info.size = len(data)
+      archive.addfile(info, StringIO(data))
+  archive.close()
+  return buf.getvalue()
+
+
+def layers(n):
+  """
+  Returns the layers of image n, from the lowest, as tar archives. The
+  base layer is shared by every image and the top layer varies with n,
+  so that the image content checks find something in some images.
+  """
+  with _layers_lock:
+    if n not in _layers:
+      base = tar([('bin', 0755, None), ('bin/sh', 0755, 'sh' * 512),
+                  ('bin/su', 04755, 'su' * 512), ('tmp', 01777, None),
+                  ('etc', 0755, None), ('etc/shadow', 0640, 'root:*:1:')])
+      top = [('srv', 0755, None), ('srv/app', 0755, 'app%d' %n * 256)]
+      if n % 4 == 0:
+        top.append(('srv/uploads', 0777, None))
+      if n % 6 == 0:
+        top += [('root', 0700, None), ('root/.ssh', 0700, None),
+                ('root/.ssh/id_rsa', 0600, 'KEY')]
+      if n % 5 == 0:
+        top.append(('bin/.wh.su', 0644, ''))
+      _layers[n] = [base, tar(top)]
+    return _layers[n]
+
+
+def diff_id(layer):
+  return 'sha256:' + hashlib.sha256(layer).hexdigest()
+
+
+def save(n):
+  """
+  Returns image n as a docker save archive, in the OCI layout of Docker
+  25 and later for odd images and in the legacy format for the others
+  """
+  if n % 2:
+    return save_oci(n)
+  entries = []
+  paths = []
+  for index, layer in enumerate(layers(n)):
+    layer_dir = hashlib.sha256('%d:%d' %(n, index)).hexdigest()
+    entries += [(layer_dir, 0755, None),
+                (layer_dir + '/VERSION', 0644, '1.0'),
+                (layer_dir + '/json', 0644, json.dumps({'id': layer_dir})),
+                (layer_dir + '/layer.tar', 0644, layer)]
+    paths.append(layer_dir + '/layer.tar')
+  config = image_id(n).split(':')[1] + '.json'
+  entries += [(config, 0644, json.dumps(image(n))),
+              ('manifest.json', 0644,
+               json.dumps([{'Config': config, 'Layers': paths,
+                            'RepoTags': ['bench/image%d:latest' %n]}]))]
+  return tar(entries)
+
+
+def save_oci(n):
+  """Returns image n as a docker save archive in the OCI layout"""
+  entries = [('blobs', 0755, None), ('blobs/sha256', 0755, None)]
+  paths = []
+  for layer in layers(n):
+    path = 'blobs/sha256/' + diff_id(layer).split(':')[1]
+    entries.append((path, 0644, layer))
+    paths.append(path)
+  config = json.dumps(image(n))
+  config_path = 'blobs/sha256/' + hashlib.sha256(config).hexdigest()
+  entries += [(config_path, 0644, config),
+              ('index.json', 0644, json.dumps({'schemaVersion': 2})),
+              ('manifest.json', 0644,
+               json.dumps([{'Config': config_path, 'Layers': paths,
+                            'RepoTags': ['bench/image%d:latest' %n]}])),
+              ('oci-layout', 0644, '{"imageLayoutVersion": "1.0.0"}')]
+  return tar(entries)
+
+
+def image(n):
+  """Returns the inspect document of image n"""
+  config = {
+    'User': '' if n % 2 else 'nginx',
+    'ExposedPorts': {'80/tcp': {}, '22/tcp': {}} if n % 7 == 0 \
+                    else {'80/tcp': {}},
+    'Env': ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin'],
+    'Cmd': ['nginx', '-g', 'daemon off;'],
+    }
+  if n % 3 == 0:
+    config['Healthcheck'] = {'Test': ['CMD', 'curl', '-f', 'http://localhost/']}
+  return {
+    'Id': image_id(n),
+    'RepoTags': ['bench/image%d:latest' %n],
+    'Created': '%d-03-01T10:00:00.000000000Z' %(2014 + n % 4),
+    'Config': config,
+    'Architecture': 'amd64',
+    'Os': 'linux',
+    'Size': 190000000,
+    'RootFS': {'Type': 'layers',
+               'Layers': [diff_id(layer) for layer in layers(n)]},
+    }
+
+
+def history(n):
+  """Returns the layers of image n, newest first"""
+  layers = [{'Id': image_id(n), 'CreatedBy': '/bin/sh -c #(nop) CMD ["nginx"]'},
+            {'Id': '<missing>',
+             'CreatedBy': '/bin/sh -c #(nop) COPY file:1a2b in /etc/nginx/'}]
+  if n % 5 == 0:
+    layers.append({'Id': '<missing>',
+                   'CreatedBy': '/bin/sh -c #(nop) ADD app.tar.gz /srv/'})
+  layers.append({'Id': '<missing>',
+                 'CreatedBy': '/bin/sh -c #(nop) ADD file:9f8e in / '})
+  return layers
+
+
+def top(i):
+  """Returns the process list of container i"""
+  processes = [['root', str(10000 + i), '1', '0', '10:00', '?', '00:00:00',
+                'nginx: master process nginx -g daemon off;']]
+  if i % 15 == 0:
+    processes.append(['root', str(20000 + i), str(10000 + i), '0', '10:00',
+                      '?', '00:00:00', '/usr/sbin/sshd -D'])
+  return {'Titles': ['UID', 'PID', 'PPID', 'C', 'STIME', 'TTY', 'TIME',
+                     'CMD'],
+          'Processes': processes}
+
+
+class EngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers the Engine API requests of the container audits"""
+  protocol_version = 'HTTP/1.1'
+  routes = [
+    (re.compile(r'^/containers/json$'), 'containers'),
+    (re.compile(r'^/containers/([0-9a-f]+)/json$'), 'inspect'),
+    (re.compile(r'^/containers/([0-9a-f]+)/top$'), 'top'),
+    (re.compile(r'^/images/json$'), 'images'),
+    (re.compile(r'^/images/sha256:([0-9a-f]+)/json$'), 'image'),
+    (re.compile(r'^/images/sha256:([0-9a-f]+)/history$'), 'history'),
+    (re.compile(r'^/images/sha256:([0-9a-f]+)/get$'), 'save'),
+    (re.compile(r'^/version$'), 'version'),
+    (re.compile(r'^/_ping$'), 'ping'),
+    ]
+
+  def do_GET(self):
+    if self.server.latency:
+      time.sleep(self.server.latency)
+    path = re.sub(r'^/v[0-9.]+', '', urllib.unquote(self.path.split('?')[0]))
+    for pattern, name in self.routes:
+      match = pattern.match(path)
+      if match:
+        return getattr(self, 'get_' + name)(*match.groups())
+    self.reply(404, {'message': 'page not found'})
+
+  def container(self, cid):
+    i = int(cid, 16) - 1
+    if 0 <= i < self.server.containers:
+      return i
+    self.reply(404, {'message': 'No such container: %s' %cid})
+    return None
+
+  def get_containers(self):
+    self.reply(200, [{'Id': container_id(i), 'Image': 'bench/image%d' %(i % 50),
+                      'Names': ['/bench_%d' %i], 'Status': 'Up 2 hours'} \
+                     for i in reversed(range(self.server.containers))])
+
+  def get_inspect(self, cid):
+    i = self.container(cid)
+    if i is not None:
+      self.reply(200, inspect(i))
+
+  def get_top(self, cid):
+    i = self.container(cid)
+    if i is not None:
+      self.reply(200, top(i))
+
+  def image(self, iid):
+    n = int(iid, 16) - 1
+    if 0 <= n < min(self.server.containers, 50):
+      return n
+    self.reply(404, {'message': 'No such image: sha256:%s' %iid})
+    return None
+
+  def get_image(self, iid):
+    n = self.image(iid)
+    if n is not None:
+      self.reply(200, image(n))
+
+  def get_history(self, iid):
+    n = self.image(iid)
+    if n is not None:
+      self.reply(200, history(n))
+
+  def get_save(self, iid):
+    n = self.image(iid)
+    if n is None:
+      return
+    body = save(n)
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/x-tar')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def get_images(self):
+    self.reply(200, [{'Id': image_id(i), 'RepoTags': ['bench/image%d:latest' %i]} \
+                     for i in range(min(self.server.containers, 50))])
+
+  def get_version(self):
+    self.reply(200, VERSION)
+
+  def get_ping(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write('OK')
+
+  def reply(self, status, doc):
+    body = json.dumps(doc)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self):
+    # Unix socket peers have no address
+    return 'unix'
+
+  def log_message(self, format, *args):
+    pass
+
+
+class FakeDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Threaded Engine API server for a number of synthetic containers"""
+  daemon_threads = True
+
+  def __init__(self, path, containers, latency=0):
+    if os.path.exists(path):
+      os.remove(path)
+    SocketServer.UnixStreamServer.__init__(self, path, EngineHandler)
+    self.containers = containers
+    self.latency = latency
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    os.remove(self.server_address)
+
+
+def serve(path, containers, latency=0):
+  """Runs a fake daemon until the process is terminated"""
+  daemon = FakeDaemon(path, containers, latency)
+  try:
+    daemon.serve_forever()
+  finally:
+    daemon.server_close()
+
+
+def wait_ready(path, timeout=10):
+  """Waits until a fake daemon accepts connections"""
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(path)
+      return True
+    except socket.error:
+      time.sleep(0.05)
+    finally:
+      sock.close()
+  return False
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description="Fake Docker daemon")
+  parser.add_argument("socket", help="Path of the unix socket")
+  parser.add_argument("-n", "--containers", type=int, default=10)
+  parser.add_argument("-l", "--latency", type=float, default=0,
+                      help="Latency added to each request, in ms")
+  args = parser.parse_args()
+  serve(args.socket, args.containers, args.latency / 1000.0)
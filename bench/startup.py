@@ -0,0 +1,132 @@
+"""
+Measures the startup cost of drydock.py for different kinds of runs.
+
+  python -m bench.startup -r 10
+
+Each scenario runs drydock.py in a new interpreter, with an empty
+profile cache for the first (cold) run. The wall time of cold and warm
+runs is reported along with the heavy modules a warm run imports.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+from bench.fakedaemon import serve, wait_ready
+
+# Modules whose import dominates startup
+HEAVY = ('docker', 'requests', 'psutil', 'yaml', 'colorama', 'junit_xml',
+         'multiprocessing')
+
+# Runs drydock.py and reports the heavy modules it imported on exit
+WRAPPER = """
+import sys, json, atexit, runpy
+def report():
+  with open(%r, 'w') as f:
+    json.dump(sorted(m for m in %r if m in sys.modules), f)
+atexit.register(report)
+sys.argv = ['drydock.py'] + %r
+runpy.run_path('drydock.py', run_name='__main__')
+"""
+
+PROFILES = {
+  'local': {'dockerfiles': [{'check_owner': {'user': 'root',
+                                             'paths': ['/etc']}}]},
+  'containers': {'container_imgs': ['container_user'],
+                 'container_runtime': ['privileged_containers',
+                                       'host_network_mode']},
+  }
+
+SCENARIOS = [
+  ('help', None, ['--help']),
+  ('local, json', 'local', []),
+  ('containers, json', 'containers', []),
+  ('containers, ndjson', 'containers', ['-f', 'ndjson']),
+  ('containers, xml', 'containers', ['-f', 'xml']),
+  ]
+
+
+def run(args, env, loaded):
+  """Runs drydock.py once, returns the wall time and imported modules"""
+  code = WRAPPER %(loaded, HEAVY, args)
+  started = time.time()
+  with open(os.devnull, 'w') as devnull:
+    subprocess.call([sys.executable, '-c', code], env=env,
+                    stdout=devnull, stderr=devnull)
+  elapsed = time.time() - started
+  try:
+    with open(loaded) as f:
+      modules = json.load(f)
+    os.remove(loaded)
+  except (IOError, ValueError):
+    modules = None
+  return elapsed, modules
+
+
+def benchmark(repeat, tmpdir, url):
+  results = []
+  for name, profile, extra in SCENARIOS:
+    args = list(extra)
+    if profile:
+      path = os.path.join(tmpdir, profile + '.yml')
+      with open(path, 'w') as f:
+        json.dump(PROFILES[profile], f)
+      args += ['-p', path, '-d', url, '-o', os.path.join(tmpdir, 'report')]
+    # Every scenario starts with an empty profile cache
+    env = dict(os.environ, XDG_CACHE_HOME=tempfile.mkdtemp(dir=tmpdir))
+    loaded = os.path.join(tmpdir, 'modules.json')
+    cold, _ = run(args, env, loaded)
+    warm = []
+    for _ in range(repeat):
+      elapsed, modules = run(args, env, loaded)
+      warm.append(elapsed)
+    results.append({'scenario': name,
+                    'cold': round(cold, 4),
+                    'warm_min': round(min(warm), 4),
+                    'warm_mean': round(sum(warm) / len(warm), 4),
+                    'modules': modules})
+  return results
+
+
+def print_results(results):
+  row = '%-20s %8s %10s %10s  %s'
+  print(row %('scenario', 'cold(s)', 'warm min', 'warm mean', 'heavy modules'))
+  for res in results:
+    print(row %(res['scenario'], '%.3f' %res['cold'], '%.3f' %res['warm_min'],
+                '%.3f' %res['warm_mean'], ', '.join(res['modules'] or ['?'])))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="drydock startup benchmark")
+  parser.add_argument("-r", "--repeat", type=int, default=5,
+                      help="Warm runs per scenario")
+  parser.add_argument("-o", "--output", help="Save the results as JSON")
+  args = parser.parse_args()
+
+  tmpdir = tempfile.mkdtemp(prefix='drydock-startup-')
+  path = os.path.join(tmpdir, 'docker.sock')
+  daemon = multiprocessing.Process(target=serve, args=(path, 10))
+  daemon.daemon = True
+  daemon.start()
+  try:
+    if not wait_ready(path):
+      raise RuntimeError("Fake daemon did not start on %s" %path)
+    results = benchmark(args.repeat, tmpdir, 'unix://' + path)
+  finally:
+    daemon.terminate()
+    daemon.join()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  print_results(results)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'results': results}, f, sort_keys=True, indent=4,
+                separators=(',', ': '))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 import argparse
 import logging
+import os
 import sys
+import socket
+import time
 
-from audits.host import HostConfAudit
-from audits.dock import DockerConfAudit, DockerFileAudit
-from audits.containers import ContainerImgAudit, ContainerRuntimeAudit
+# Audit categories, output formats and the Docker client are imported
+# when the profile and options need them, which keeps startup short
+from audits import create_categories, needs_session
+from audits.processes import ProcessTable
+from audits.snapshot import DEFAULT_WORKERS
 
 from utils.confparse import ConfParse
-from utils.output import FormattedOutput
 
 def main():
   # Argument parsing.
@@ -21,7 +25,26 @@ def main():
   parser.add_argument("-d", "--daemon",help="Docker daemon host <IP:port>")
   parser.add_argument("-c", "--cert",help="Client certificate")
   parser.add_argument("-k", "--key",help="Client certificate key")
-  parser.add_argument("-f", "--format",help="JUnit XML or JSON", default="json")
+  parser.add_argument("-f", "--format",help="JUnit XML, JSON or NDJSON", default="json")
+  parser.add_argument("-w", "--workers",help="Concurrent Docker API requests",
+                      type=int, default=DEFAULT_WORKERS)
+  parser.add_argument("--serial",help="Run audit categories one at a time",
+                      action="store_true")
+  parser.add_argument("-b", "--backend",help="Docker API fetch backend",
+                      choices=['threads', 'async'], default='threads')
+  parser.add_argument("--cache",help="Verdict cache file for incremental re-audits")
+  parser.add_argument("--watch",help="Keep container results current from daemon events",
+                      action="store_true")
+  parser.add_argument("--timings",help="Report time and API calls per check",
+                      action="store_true")
+  parser.add_argument("--budget",help="Seconds after which no check is started, the others are skipped",
+                      type=float)
+  parser.add_argument("--history",help="SQLite database recording the results of every run")
+  parser.add_argument("--diff",help="Compare a previous JSON/NDJSON report to this run, or to a second report",
+                      nargs='+', metavar="REPORT")
+  parser.add_argument("-i", "--inventory",help="Inventory file of daemons to audit")
+  parser.add_argument("-j", "--jobs",help="Hosts audited concurrently in fleet mode (default: CPU count)",
+                      type=int)
   args = parser.parse_args()
 
   # Verbosity level - Default is ERROR
@@ -39,8 +62,8 @@ def main():
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
   # Parse format
-  if args.format.lower() != 'xml' and args.format.lower() != 'json':
-      logging.error("Invalid option %s - it should be either json or xml" % (args.format))
+  if args.format.lower() not in ('xml', 'json', 'ndjson'):
+      logging.error("Invalid option %s - it should be json, ndjson or xml" % (args.format))
       sys.exit(1)
 
   # If no profile specified, switch to default
@@ -54,46 +77,167 @@ def main():
   outfile = args.output + "." + args.format
   if args.daemon:
     daemon = args.daemon
-  if args.cert:
-    cert = args.cert
-  if args.key:
-    key = args.key
+
+  if args.diff and len(args.diff) > 2:
+    logging.error("--diff takes a previous report, or two reports to compare")
+    sys.exit(1)
+  if args.diff and len(args.diff) == 2:
+    delta = compare_reports(args.diff[0], args.diff[1])
+    save_delta(delta, args.output)
+    return
+  if args.diff and args.inventory and args.format == 'xml':
+    logging.error("Fleet reports can only be compared in JSON or NDJSON")
+    sys.exit(1)
+  if args.diff and os.path.abspath(args.diff[0]) == os.path.abspath(outfile):
+    # Reports are written while checks run, before they are compared
+    logging.error("The report to compare must not be the output file %s" \
+                  %outfile)
+    sys.exit(1)
 
   profile = confparser.load_conf(conf)
-  audit_categories = {
-                      'dockerconf': DockerConfAudit(),
-                      'dockerfiles': DockerFileAudit(),
-                      }
-  if args.daemon and args.cert and args.key:
-    audit_categories['host'] = HostConfAudit(url=daemon, cert=cert, key=key)
-    audit_categories['container_imgs'] = ContainerImgAudit(url=daemon, cert=cert, key=key)
-    audit_categories['container_runtime'] = ContainerRuntimeAudit(url=daemon, cert=cert, key=key)
-  elif args.daemon:
-    audit_categories['host'] = HostConfAudit(url=daemon)
-    audit_categories['container_imgs'] = ContainerImgAudit(url=daemon)
-    audit_categories['container_runtime'] = ContainerRuntimeAudit(url=daemon)
-  else:
-    audit_categories['host'] = HostConfAudit()
-    audit_categories['container_imgs'] = ContainerImgAudit()
-    audit_categories['container_runtime'] = ContainerRuntimeAudit()
+  costs = None
+  if args.budget:
+    from utils.scheduler import recorded_costs
+    # Timings of the previous run, before its report is replaced
+    costs = recorded_costs(outfile)
+  if args.inventory:
+    audit_inventory(args, profile, conf, outfile, costs)
+    return
+
+  # All categories talk to the daemon through one session, which pools
+  # connections and fetches the container list and inspect data only once.
+  # Profiles with local categories only need no session at all.
+  session = None
+  if needs_session(profile.keys()):
+    from audits.session import DockerSession
+    if args.daemon:
+      session = DockerSession(url=daemon, cert=args.cert, key=args.key,
+                              workers=args.workers, backend=args.backend,
+                              cache=args.cache)
+    else:
+      session = DockerSession(workers=args.workers, backend=args.backend,
+                              cache=args.cache)
+  from utils.output import FormattedOutput
+  from utils.scheduler import run_categories
+  # Host checks share a single snapshot of the process table
+  audit_categories = create_categories(session, ProcessTable(),
+                                       profile.keys())
 
   out = FormattedOutput(outfile, **audit_categories)
-  for cat,auditclass in audit_categories.iteritems():
-    if cat in profile.keys():
-      try:
-        auditcat = profile[cat]
-        audit = auditclass
-        audit.run_audits(auditcat)
-        out.save_results(cat, audit.logdict)
-      except KeyError:
-        logging.error("No audit category '%s' defined." %cat)
+  stream = None
+  if args.format in ('ndjson', 'xml'):
+    from utils.stream import ResultStream
+    # Results are written as soon as each check finishes. Their output
+    # is only kept in out.log when --diff, --history or --watch need it
+    keep = bool(args.diff or args.history or args.watch)
+    stream = ResultStream(outfile, args.format, keep_output=keep)
+    stream.attach(audit_categories)
+  started = int(time.time())
+  # The budget starts with the checks, once the daemon is connected
+  deadline = time.time() + args.budget if args.budget else None
+  # Categories run concurrently; results are saved in a fixed order
+  results = run_categories(audit_categories, profile,
+                           parallel=not args.serial, deadline=deadline,
+                           costs=costs)
+  for cat, logdict in results:
+    out.save_results(cat, logdict)
+  if args.timings or deadline:
+    # Budgeted runs order checks by the timings of the previous report
+    out.save_timings()
+
+  if stream:
+    out.audit_init_info(conf)
+    stream.close(out.log['info'], out.log.get('timings'))
+  else:
+    write_report(out, args.format, conf)
+  if args.history:
+    out.audit_init_info(conf)
+    record_history(args.history, args.daemon or socket.gethostname(),
+                   out.log, started,
+                   session.container_images() if session else None)
+  out.terminal_output()
+  if args.timings:
+    out.print_timings()
+  if args.diff:
+    out.audit_init_info(conf)
+    save_delta(compare_reports(args.diff[0], out.log), args.output)
+  if args.watch and session is None:
+    logging.error("Nothing to watch, the profile has no container audits")
+  elif args.watch:
+    from utils.watch import Watcher
+    # Events since the start of the audit are replayed, none is missed
+    watcher = Watcher(session, audit_categories, profile,
+                      on_change=lambda: write_report(out, args.format, conf))
+    watcher.run(since=started)
+  if session is not None:
+    session.close()
 
+def write_report(out, fmt, conf):
   out.audit_init_info(conf)
-  if args.format == 'json':
+  if fmt == 'json':
     out.write_file()
+  elif fmt == 'ndjson':
+    out.write_ndjson_file()
   else:
     out.write_xml_file()
-  out.terminal_output()
+
+def record_history(path, host, log, started, images=None):
+  from utils.history import HistoryStore
+  store = HistoryStore(path)
+  try:
+    store.record(host, log, started, images)
+  finally:
+    store.close()
+
+def compare_reports(old, new):
+  """Compares a report file to a second one, or to the log of a run"""
+  from utils.diff import diff_files, diff_log
+  try:
+    if isinstance(new, dict):
+      return diff_log(old, new)
+    return diff_files(old, new)
+  except (IOError, ValueError) as e:
+    logging.error("Unable to compare reports: %s" %e)
+    sys.exit(1)
+
+def save_delta(delta, output):
+  from utils.diff import write_delta, print_delta
+  write_delta(delta, output + '.diff.json')
+  print_delta(delta)
+
+def audit_inventory(args, profile, conf, outfile, costs=None):
+  """Fleet mode - audits every daemon of an inventory file"""
+  import multiprocessing
+  from utils.fleet import load_inventory, remote_profile, audit_fleet, \
+                          FleetReport
+  hosts = load_inventory(args.inventory)
+  jobs = args.jobs or multiprocessing.cpu_count()
+  # The budget covers the audits of the whole fleet
+  deadline = time.time() + args.budget if args.budget else None
+  options = {'workers': args.workers,
+             'backend': args.backend,
+             'parallel': not args.serial,
+             'cache': args.cache,
+             'timings': args.timings or bool(deadline),
+             'history': bool(args.history),
+             'deadline': deadline,
+             'costs': costs}
+  report = FleetReport(outfile, hosts, args.format)
+  started = int(time.time())
+  for name, results, error, timings, images in \
+      audit_fleet(hosts, remote_profile(profile), options, jobs):
+    if error:
+      logging.error("Audit of %s failed: %s" %(name, error))
+    # Only the host's info is kept once its section is written
+    log = report.add_host(name, results, error, timings)
+    if args.history and not error:
+      record_history(args.history, name, log, started, images)
+
+  report.close(conf)
+  report.terminal_output()
+  if args.diff:
+    # The new report is read back from its file
+    save_delta(compare_reports(args.diff[0], outfile), args.output)
 
 if  __name__ =='__main__':
     main()
@@ -1,17 +1,198 @@
-import yaml
+import os
 import sys
+import json
+import inspect
+import hashlib
 import logging
 
+from audits import CATEGORIES, load_category
+from audits.rules import Rule
+
+PLAN_VERSION = 1
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                         os.path.expanduser('~/.cache')),
+                         'drydock')
+
+
+def load_yaml(stream):
+  """
+  Parses YAML with the C loader (libyaml) when PyYAML is built with it.
+  PyYAML is only imported when a file has to be parsed.
+  """
+  import yaml
+  return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader',
+                                          yaml.SafeLoader))
+
+
+def check_methods(auditclass):
+  """Returns the checks of an audit category by name"""
+  checks = {}
+  for name, member in inspect.getmembers(auditclass, inspect.ismethod):
+    if hasattr(member, 'order'):
+      checks[name] = member
+  return checks
+
+
+def signatures(cats):
+  """
+  Digest of the check signatures of the categories in a plan, which
+  invalidates cached plans
+  """
+  sigs = []
+  for cat in sorted(cats):
+    checks = check_methods(load_category(cat))
+    for name, check in sorted(checks.iteritems()):
+      sigs.append([cat, name, inspect.getargspec(check)[0]])
+  return hashlib.sha1(json.dumps(sigs)).hexdigest()
+
+
+class ProfileError(Exception):
+  """A profile does not match the available checks"""
+
+
 class ConfParse:
 
+  def __init__(self, cache_dir=CACHE_DIR):
+    self.cache_dir = cache_dir
+
   def load_conf(self,conf):
-    """ 
-    Loads and parses an audit category from a configuration file
+    """
+    Loads a profile and compiles it into an execution plan. Plans are
+    cached by file and reused while the profile and the checks are
+    unchanged.
     """
     try:
-      with open(conf) as conf:
-        profile = yaml.load(conf)
-    except IOError:
-      logging.error("Invalid file specified: %s" %(conf)) 
+      st = os.stat(conf)
+    except OSError:
+      logging.error("Invalid file specified: %s" %(conf))
       sys.exit(0)
-    return profile
\ No newline at end of file
+    cache = self.cache_path(conf)
+    cached = self.read_cache(cache)
+    if cached and cached['signatures'] != signatures(cached['plan']):
+      cached = None
+    if cached and (cached['mtime'], cached['size']) == (st.st_mtime,
+                                                        st.st_size):
+      logging.debug("Using cached plan of %s" %conf)
+      return cached['plan']
+
+    with open(conf) as f:
+      data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    if cached and cached['sha1'] == sha1:
+      # Touched, but not modified
+      plan = cached['plan']
+    else:
+      plan = self.compile_file(conf, data)
+    self.write_cache(cache, {'version': PLAN_VERSION,
+                             'signatures': signatures(plan),
+                             'mtime': st.st_mtime,
+                             'size': st.st_size,
+                             'sha1': sha1,
+                             'plan': plan})
+    return plan
+
+  def compile_file(self,conf,data):
+    """Compiles the contents of a profile, exiting on errors"""
+    try:
+      profile = load_yaml(data)
+    except Exception as e:
+      # yaml.YAMLError, without importing PyYAML up front
+      logging.error("Invalid profile %s: %s" %(conf, e))
+      sys.exit(1)
+    try:
+      return self.compile(profile)
+    except ProfileError as e:
+      for error in e.args[0]:
+        logging.error("Invalid profile %s: %s" %(conf, error))
+      sys.exit(1)
+
+  def compile(self,profile):
+    """
+    Validates a profile against the checks of each category and returns
+    the plan: for every category, the checks to run either by name or
+    as {check: {argument: value}}, with the arguments bound by name.
+    Raises ProfileError with every problem found.
+    """
+    if not isinstance(profile, dict):
+      raise ProfileError(["A profile maps audit categories to checks"])
+    plan = {}
+    errors = []
+    for cat, audits in profile.iteritems():
+      if cat not in CATEGORIES:
+        errors.append("No audit category '%s'" %cat)
+        continue
+      auditclass = load_category(cat)
+      plan[cat] = []
+      checks = check_methods(auditclass)
+      for audit in audits or []:
+        try:
+          plan[cat].append(self.compile_audit(auditclass, checks, audit))
+        except ValueError as e:
+          errors.append("%s: %s" %(cat, e))
+    if errors:
+      raise ProfileError(errors)
+    return plan
+
+  def compile_audit(self,auditclass,checks,audit):
+    """Validates a profile entry and returns its plan step"""
+    if isinstance(audit, basestring):
+      name, args = audit, None
+    elif isinstance(audit, dict) and len(audit) == 1:
+      name, args = audit.items()[0]
+    else:
+      raise ValueError("Invalid entry %r" %(audit,))
+
+    builtin = getattr(auditclass, 'runtime_rules', None)
+    if name == 'rule' and builtin is not None:
+      rule = Rule.from_profile(args)
+      # Rules may redefine the built-in ones, not other checks
+      if rule.name in checks and rule.name not in [r.name for r in builtin]:
+        raise ValueError("Rule %s conflicts with an audit" %rule.name)
+      return audit
+    if name not in checks:
+      raise ValueError("No audit named %s" %name)
+
+    if args is None:
+      args = {}
+    elif not isinstance(args, dict):
+      raise ValueError("Arguments of %s should be given by name" %name)
+    argnames, _, _, defaults = inspect.getargspec(checks[name])
+    argnames = argnames[1:]
+    required = argnames[:len(argnames) - len(defaults or ())]
+    unknown = [arg for arg in args if arg not in argnames]
+    if unknown:
+      raise ValueError("Unknown arguments of %s: %s (expected %s)" \
+                       %(name, ', '.join(unknown), ', '.join(argnames)))
+    missing = [arg for arg in required if arg not in args]
+    if missing:
+      raise ValueError("Missing arguments of %s: %s" \
+                       %(name, ', '.join(missing)))
+    if not args:
+      return name
+    return {name: args}
+
+  def cache_path(self,conf):
+    key = hashlib.sha1(os.path.abspath(conf)).hexdigest()
+    return os.path.join(self.cache_dir, key + '.json')
+
+  def read_cache(self,path):
+    try:
+      with open(path) as f:
+        cached = json.load(f)
+    except (IOError, ValueError):
+      return None
+    if not isinstance(cached, dict) or cached.get('version') != PLAN_VERSION:
+      return None
+    return cached
+
+  def write_cache(self,path,cached):
+    """Saves a plan, atomically. Plans are an optimization only."""
+    tmp = path + '.tmp'
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      with open(tmp, 'w') as f:
+        json.dump(cached, f)
+      os.rename(tmp, path)
+    except (IOError, OSError) as e:
+      logging.debug("Unable to cache profile plan in %s: %s" %(path, e))
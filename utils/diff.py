@@ -0,0 +1,316 @@
+"""
+Differences between two audit reports: checks whose status changed,
+findings which appeared or were fixed, and score changes per category.
+
+Reports are compared by digests of their findings. The old report is
+indexed as a set of digests per check, then the new one is read once,
+and the old one a second time only to pick the findings which were
+fixed. Only the digests and the delta are kept in memory: NDJSON
+reports are read one record at a time, JSON reports one category at a
+time.
+"""
+import json
+import hashlib
+import logging
+
+from utils.stream import SECTIONS, output_items
+
+# Bytes read at a time from JSON reports
+READ_SIZE = 65536
+
+
+def digest(item):
+  return hashlib.sha1(json.dumps(item, sort_keys=True)).digest()
+
+
+def status(results):
+  try:
+    return results['status']
+  except (KeyError, TypeError):
+    return None
+
+
+def category_records(cat, checks, host=None):
+  """Yields the check and finding records of a category's results"""
+  if cat in SECTIONS or not isinstance(checks, dict):
+    return
+  for name, results in sorted(checks.iteritems()):
+    yield {'host': host, 'category': cat, 'check': name,
+           'status': status(results)}
+    for item in output_items(results):
+      yield {'host': host, 'category': cat, 'check': name, 'finding': item}
+
+
+def log_records(log, host=None):
+  """
+  Yields the records of a report as a dict, e.g. FormattedOutput.log or
+  FleetReport.log, with the fields of NDJSON records: check records
+  (category, check, status), one finding record per finding and info
+  records.
+  """
+  if 'hosts' in log:
+    for name, host_log in sorted(log['hosts'].iteritems()):
+      for record in log_records(host_log, name):
+        yield record
+    if 'info' in log:
+      yield {'info': log['info']}
+    return
+  for cat, checks in sorted(log.iteritems()):
+    for record in category_records(cat, checks, host):
+      yield record
+  if 'info' in log:
+    yield {'host': host, 'info': log['info']}
+
+
+class JsonReader(object):
+  """
+  Reads the members of JSON objects from a file one at a time, so that
+  a report is decoded a category at a time instead of as a whole
+  """
+
+  def __init__(self, f):
+    self.file = f
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def fill(self):
+    """Reads more of the file, at least as much as is buffered"""
+    data = self.file.read(max(READ_SIZE, len(self.buf) - self.pos))
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    self.eof = not data
+
+  def char(self):
+    """Returns the next character which is not white space"""
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if self.eof:
+        raise ValueError("Unexpected end of JSON report")
+      self.fill()
+
+  def expect(self, chars):
+    char = self.char()
+    if char not in chars:
+      raise ValueError("Expected %s in JSON report, found %s" \
+                       %(' or '.join(chars), char))
+    self.pos += 1
+    return char
+
+  def value(self):
+    """Decodes the next value"""
+    self.char()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # A number may go on in the part not read yet
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self.fill()
+
+  def keys(self):
+    """
+    Yields the keys of the next object. The value of each key is to be
+    read, with value() or keys(), before the next key.
+    """
+    self.expect('{')
+    if self.char() == '}':
+      self.pos += 1
+      return
+    while True:
+      key = self.value()
+      self.expect(':')
+      yield key
+      if self.expect(',}') == '}':
+        return
+
+
+def json_records(f):
+  """Yields the records of a JSON report, decoding a category at a time"""
+  reader = JsonReader(f)
+  for key in reader.keys():
+    if key == 'hosts':
+      for host in reader.keys():
+        for cat in reader.keys():
+          value = reader.value()
+          if cat == 'info':
+            yield {'host': host, 'info': value}
+          for record in category_records(cat, value, host):
+            yield record
+    elif key == 'info':
+      yield {'info': reader.value()}
+    else:
+      for record in category_records(key, reader.value()):
+        yield record
+
+
+def report_records(path):
+  """Yields the records of a JSON or NDJSON report file"""
+  if path.endswith('.xml'):
+    raise ValueError("%s: only JSON and NDJSON reports can be compared" %path)
+  with open(path) as f:
+    if path.endswith('.ndjson'):
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      for record in json_records(f):
+        yield record
+
+
+def score(counts):
+  return "%d/%d" %(counts[0], counts[1])
+
+
+class ReportDiff(object):
+  """
+  Compares new reports against an old report, given as a function
+  returning its records. New reports are read once, the old report
+  once more when findings were fixed.
+  """
+
+  def __init__(self, old_records):
+    self.old_records = old_records
+    self.statuses = {}
+    self.findings = {}
+    self.info = {}
+    for record in old_records():
+      self.index(record)
+
+  def key(self, record):
+    return record.get('host'), record['category'], record['check']
+
+  def index(self, record):
+    if 'info' in record:
+      self.info[record.get('host')] = record['info']
+    elif 'finding' in record:
+      self.findings.setdefault(self.key(record), set()) \
+                   .add(digest(record['finding']))
+    elif 'check' in record:
+      self.statuses[self.key(record)] = record.get('status')
+
+  def compare(self, new_records):
+    """
+    Returns the delta from the old report to a new one: the checks
+    whose status or findings changed, the categories whose score
+    changed, and the scores of both reports.
+    """
+    statuses = {}
+    info = {}
+    seen = {}
+    added = {}
+    for record in new_records:
+      if 'info' in record:
+        info[record.get('host')] = record['info']
+      elif 'finding' in record:
+        key = self.key(record)
+        found = digest(record['finding'])
+        if found in seen.setdefault(key, set()):
+          continue
+        seen[key].add(found)
+        if found not in self.findings.get(key, ()):
+          added.setdefault(key, []).append(record['finding'])
+      elif 'check' in record:
+        statuses[self.key(record)] = record.get('status')
+
+    unseen = {}
+    for key, found in self.findings.iteritems():
+      fixed = found - seen.get(key, set())
+      if fixed:
+        unseen[key] = fixed
+    removed = {}
+    if unseen:
+      for record in self.old_records():
+        if 'finding' not in record:
+          continue
+        key = self.key(record)
+        found = digest(record['finding'])
+        if found in unseen.get(key, ()):
+          unseen[key].discard(found)
+          removed.setdefault(key, []).append(record['finding'])
+
+    changes = []
+    for key in sorted(set(statuses) | set(self.statuses)):
+      old, new = self.statuses.get(key), statuses.get(key)
+      new_items = added.get(key, [])
+      old_items = removed.get(key, [])
+      if 'Skipped' in (old, new):
+        # The findings of checks skipped in a budgeted run are unknown
+        new_items = old_items = []
+      if old == new and not new_items and not old_items:
+        continue
+      change = {'category': key[1],
+                'check': key[2],
+                'status': [old, new],
+                'added': new_items,
+                'removed': old_items}
+      if key[0] is not None:
+        change['host'] = key[0]
+      changes.append(change)
+
+    return {'info': {'old': self.info.get(None, {}),
+                     'new': info.get(None, {})},
+            'score': [self.info.get(None, {}).get('score'),
+                      info.get(None, {}).get('score')],
+            'categories': self.categories(statuses),
+            'failures': len([c for c in changes if c['status'][0] != 'Fail' \
+                             and c['status'][1] == 'Fail']),
+            'fixed': len([c for c in changes if c['status'][0] == 'Fail' \
+                          and c['status'][1] not in ('Fail', 'Skipped')]),
+            'changes': changes}
+
+  def categories(self, new_statuses):
+    """Lists the categories whose score changed, per host in fleets"""
+    counts = {}
+    for side, statuses in enumerate((self.statuses, new_statuses)):
+      for (host, cat, check), result in statuses.iteritems():
+        if result in (None, 'Skipped'):
+          continue
+        cat_counts = counts.setdefault((host, cat), [[0, 0], [0, 0]])[side]
+        cat_counts[0] += result == 'Pass'
+        cat_counts[1] += 1
+    changed = []
+    for (host, cat), (old, new) in sorted(counts.iteritems()):
+      if old == new:
+        continue
+      entry = {'category': cat, 'score': [score(old), score(new)]}
+      if host is not None:
+        entry['host'] = host
+      changed.append(entry)
+    return changed
+
+
+def diff_files(old, new):
+  """Returns the delta between two report files"""
+  return ReportDiff(lambda: report_records(old)).compare(report_records(new))
+
+
+def diff_log(old, log):
+  """Returns the delta between a report file and the results of a run"""
+  return ReportDiff(lambda: report_records(old)).compare(log_records(log))
+
+
+def write_delta(delta, path):
+  with open(path, 'w') as f:
+    json.dump(delta, f, sort_keys=True, indent=4, separators=(',', ': '))
+  logging.debug("Saved report differences to %s" %path)
+
+
+def print_delta(delta):
+  print("Changes: %d check(s), %d new failure(s), %d fixed" \
+        %(len(delta['changes']), delta['failures'], delta['fixed']))
+  if delta['score'][0] != delta['score'][1]:
+    print("Score: %s -> %s" %tuple(delta['score']))
+  for cat in delta['categories']:
+    name = cat['category']
+    if 'host' in cat:
+      name = "%s %s" %(cat['host'], name)
+    print("  %s: %s -> %s" %(name, cat['score'][0], cat['score'][1]))
@@ -0,0 +1,233 @@
+import sys
+import json
+import logging
+import multiprocessing
+from datetime import datetime
+
+from colorama import Fore, Style
+
+from audits import CATEGORIES, load_category, create_categories
+from audits.audit import Audit
+from audits.processes import ProcessTable
+from audits.session import DockerSession
+from utils.confparse import load_yaml
+from utils.output import FormattedOutput, collect_timings
+from utils.scheduler import run_categories
+from utils.stream import NdjsonWriter, JunitWriter, SUITE_NAME
+
+
+def load_inventory(path):
+  """
+  Loads the Docker daemons of a fleet from an inventory file.
+  Settings under 'defaults' (e.g. a shared cert and key) apply to
+  every host.
+  """
+  try:
+    with open(path) as f:
+      inventory = load_yaml(f)
+  except IOError:
+    logging.error("Invalid inventory file specified: %s" %path)
+    sys.exit(1)
+  defaults = inventory.get('defaults') or {}
+  hosts = {}
+  for name, settings in (inventory.get('hosts') or {}).iteritems():
+    node = dict(defaults)
+    node.update(settings or {})
+    if 'daemon' not in node:
+      logging.error("No daemon defined for host %s" %name)
+      sys.exit(1)
+    hosts[name] = node
+  return hosts
+
+
+def remote_profile(profile):
+  """
+  Drops the audits examining the machine drydock runs on, since they
+  say nothing about the audited daemons.
+  """
+  remote = {}
+  for cat, audits in profile.iteritems():
+    if cat not in CATEGORIES or load_category(cat).local:
+      logging.warning("Skipping local audit category %s in fleet mode" %cat)
+      continue
+    remote[cat] = []
+    for audit in audits or []:
+      name = Audit.audit_names([audit])[0]
+      if name in load_category(cat).local_audits:
+        logging.warning("Skipping local audit %s in fleet mode" %name)
+      else:
+        remote[cat].append(audit)
+  return remote
+
+
+def audit_node(job):
+  """Audits a single daemon of the fleet. Runs in a worker process."""
+  name, node, profile, options = job
+  cache = None
+  timings = None
+  images = None
+  session = None
+  if options['cache']:
+    # Verdicts are cached per host
+    cache = "%s.%s" %(options['cache'], name)
+  try:
+    session = DockerSession(url=node['daemon'], cert=node.get('cert'),
+                            key=node.get('key'), workers=options['workers'],
+                            backend=options['backend'], cache=cache)
+    categories = create_categories(session, ProcessTable(), profile.keys())
+    results = run_categories(categories, profile,
+                             parallel=options['parallel'],
+                             deadline=options.get('deadline'),
+                             costs=options.get('costs'))
+    if options['timings']:
+      timings = collect_timings(categories, [cat for cat, _ in results])
+    if options.get('history'):
+      images = session.container_images()
+  except SystemExit:
+    error = "Unable to connect to docker host %s" %node['daemon']
+    return name, None, error, None, None
+  except Exception as e:
+    logging.error("Audit of %s failed: %s" %(name, e))
+    return name, None, "%s: %s" %(e.__class__.__name__, e), None, None
+  finally:
+    # Closes the kept-alive connections of the worker process
+    if session is not None:
+      session.close()
+  return name, results, None, timings, images
+
+
+def audit_fleet(hosts, profile, options, jobs):
+  """
+  Audits all daemons of the fleet with a pool of worker processes.
+  Failures are isolated per host. Yields (host, results, error, timings,
+  images), images mapping containers to their image for the history.
+  """
+  work = [(name, node, profile, options) \
+          for name, node in sorted(hosts.iteritems())]
+  if jobs <= 1:
+    for job in work:
+      yield audit_node(job)
+    return
+  pool = multiprocessing.Pool(min(jobs, len(work)))
+  try:
+    for res in pool.imap_unordered(audit_node, work):
+      yield res
+  finally:
+    pool.close()
+    pool.join()
+
+
+class FleetReport:
+  """
+  Combined report of a fleet audit, with one section per host. Each
+  section is written as soon as the audit of its host ends, and only
+  the info of the host (daemon, score or error) is kept.
+  """
+
+  def __init__(self,outfile,hosts,fmt='json'):
+    self.output = outfile
+    self.nodes = hosts
+    self.fmt = fmt
+    self.hosts = {}
+    self.info = None
+    self.passed = 0
+    self.total = 0
+    self.ran = 0
+    self.planned = 0
+    self.file = open(outfile,'w')
+    if fmt == 'xml':
+      self.writer = JunitWriter(self.file)
+    elif fmt == 'json':
+      self.file.write('{\n    "hosts": {')
+
+  def add_host(self,name,results,error,timings=None):
+    """Writes the section of a host and returns its log"""
+    info = {'daemon': self.nodes[name]['daemon']}
+    if error:
+      info['error'] = error
+      log = {'info': info}
+    else:
+      out = FormattedOutput(None)
+      for cat, logdict in results:
+        out.save_results(cat, logdict)
+      (passed, total, ran, planned) = out.get_score()
+      self.passed += passed
+      self.total += total
+      self.ran += ran
+      self.planned += planned
+      info['score'] = "%s/%s" %(passed,total)
+      info['coverage'] = "%s/%s" %(ran,planned)
+      out.log['info'] = info
+      if timings is not None:
+        out.log['timings'] = timings
+      log = out.log
+    self.write_host(name, log)
+    self.hosts[name] = info
+    return log
+
+  def write_host(self,name,log):
+    if self.fmt == 'json':
+      section = json.dumps(log, sort_keys=True,
+                           indent=4, separators=(',', ': '))
+      self.file.write('%s\n        %s: %s' \
+                      %(',' if self.hosts else '', json.dumps(name),
+                        section.replace('\n', '\n        ')))
+    elif self.fmt == 'ndjson':
+      writer = NdjsonWriter(self.file, host=name)
+      writer.results(log)
+      if 'timings' in log:
+        writer.timings(log['timings'])
+      writer.summary(log['info'])
+    else:
+      self.writer.suite("%s - %s" %(SUITE_NAME, name))
+      if 'error' in log['info']:
+        self.writer.error('audit', log['info']['error'])
+      self.writer.results(log)
+    self.file.flush()
+
+  def audit_init_info(self,profile):
+    failed = [name for name, info in self.hosts.iteritems() \
+              if 'error' in info]
+    info = {}
+    info['date'] = str(datetime.now())
+    info['profile'] = profile
+    info['score'] = "%s/%s" %(self.passed,self.total)
+    info['coverage'] = "%s/%s" %(self.ran,self.planned)
+    info['hosts'] = len(self.hosts)
+    info['failed_hosts'] = sorted(failed)
+    self.info = info
+
+  def close(self,profile):
+    """Writes the fleet info and score, closing the report"""
+    self.audit_init_info(profile)
+    if self.fmt == 'json':
+      info = json.dumps(self.info, sort_keys=True,
+                        indent=4, separators=(',', ': '))
+      self.file.write('\n    },\n    "info": %s\n}' \
+                      %info.replace('\n', '\n    '))
+    elif self.fmt == 'ndjson':
+      NdjsonWriter(self.file).summary(self.info)
+    else:
+      self.writer.summary(self.info)
+    self.file.close()
+
+  def terminal_output(self):
+    print '''drydock v0.3 Fleet Audit Results\n================================\n'''
+    for name, info in sorted(self.hosts.iteritems()):
+      if 'error' in info:
+        print(name + ': ' + Fore.RED + info['error'] + Fore.RESET)
+      else:
+        run, planned = info['coverage'].split('/')
+        if run != planned:
+          print(name + ': ' + info['score'] + Fore.YELLOW + \
+                ' (%s checks run)' %info['coverage'] + Fore.RESET)
+        else:
+          print(name + ': ' + info['score'])
+    info = self.info
+    print(Style.BRIGHT + "\nOverview\n--------" +Style.RESET_ALL)
+    print('Profile: ' + info['profile'])
+    print('Date: ' + info['date'])
+    print('Hosts: %d (%d failed)' %(info['hosts'], len(info['failed_hosts'])))
+    print('Score: ' + info['score'])
+    if self.ran != self.planned:
+      print('Coverage: ' + info['coverage'])
@@ -0,0 +1,251 @@
+"""
+History of audit results in a SQLite database.
+
+Every run is recorded with the status of each check and one row per
+finding, linked to the container and image it concerns when there is
+one. Queries answer how results evolve and when findings appeared:
+
+  python -m utils.history audits.db trend -c privileged_containers
+  python -m utils.history audits.db seen --container 4f2a -c privileged_containers
+"""
+import re
+import json
+import time
+import sqlite3
+import argparse
+
+from utils.stream import SECTIONS, output_items
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  host TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  profile TEXT,
+  passed INTEGER,
+  total INTEGER
+);
+CREATE TABLE IF NOT EXISTS checks (
+  run INTEGER NOT NULL REFERENCES runs(id),
+  host TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  category TEXT NOT NULL,
+  check_name TEXT NOT NULL,
+  status TEXT,
+  descr TEXT
+);
+CREATE TABLE IF NOT EXISTS findings (
+  run INTEGER NOT NULL REFERENCES runs(id),
+  host TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  category TEXT NOT NULL,
+  check_name TEXT NOT NULL,
+  container TEXT,
+  image TEXT,
+  finding TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_host ON runs(host, ts);
+CREATE INDEX IF NOT EXISTS checks_run ON checks(run);
+CREATE INDEX IF NOT EXISTS checks_check ON checks(check_name, host, ts);
+CREATE INDEX IF NOT EXISTS findings_run ON findings(run, check_name);
+CREATE INDEX IF NOT EXISTS findings_host ON findings(host, ts);
+CREATE INDEX IF NOT EXISTS findings_check ON findings(check_name, ts);
+CREATE INDEX IF NOT EXISTS findings_container ON findings(container, ts);
+CREATE INDEX IF NOT EXISTS findings_image ON findings(image, ts);
+CREATE INDEX IF NOT EXISTS findings_ts ON findings(ts);
+"""
+CONTAINER_ID = re.compile(r'^[0-9a-f]{64}$')
+
+
+def container_of(item, images):
+  """Returns the container a finding concerns, if any"""
+  values = item if isinstance(item, (list, tuple)) else [item]
+  for value in values:
+    if isinstance(value, basestring) and \
+       (value in images or CONTAINER_ID.match(value)):
+      return value
+  return None
+
+
+def finding_rows(category, check, results, images):
+  """
+  Yields (container, image, finding) for the findings of a check.
+  Findings of image checks are recorded for every container using the
+  image, others are linked to the container they name.
+  """
+  for item in output_items(results):
+    if isinstance(item, (list, tuple)) and len(item) == 2 and \
+       isinstance(item[1], dict) and 'containers' in item[1]:
+      finding = json.dumps(item[1].get('findings'), sort_keys=True)
+      for container in item[1]['containers']:
+        yield container, item[0], finding
+      continue
+    container = container_of(item, images)
+    if isinstance(item, basestring):
+      finding = item
+    else:
+      finding = json.dumps(item, sort_keys=True)
+    yield container, images.get(container), finding
+
+
+class HistoryStore(object):
+  """Records audit runs in a SQLite database and queries them"""
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(SCHEMA)
+
+  def record(self, host, log, started=None, images=None):
+    """
+    Records the report of a run, e.g. FormattedOutput.log, in a single
+    transaction. images maps container IDs to their image, to link the
+    findings of container checks to images.
+    """
+    ts = int(started or time.time())
+    images = images or {}
+    info = log.get('info', {})
+    passed, total = (info.get('score') or '/').split('/')
+    with self.db:
+      cur = self.db.execute(
+        "INSERT INTO runs (host, ts, profile, passed, total) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (host, ts, info.get('profile'), passed or None, total or None))
+      run = cur.lastrowid
+      checks = []
+      findings = []
+      for cat, results in sorted(log.iteritems()):
+        if cat in SECTIONS or not isinstance(results, dict):
+          continue
+        for check, res in sorted(results.iteritems()):
+          if not isinstance(res, dict):
+            continue
+          checks.append((run, host, ts, cat, check, res.get('status'),
+                         res.get('descr')))
+          for container, image, finding in finding_rows(cat, check, res,
+                                                        images):
+            findings.append((run, host, ts, cat, check, container, image,
+                             finding))
+      self.db.executemany(
+        "INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)", checks)
+      self.db.executemany(
+        "INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?, ?)", findings)
+    return run
+
+  def trend(self, host=None, check=None, limit=20):
+    """
+    Returns the latest runs, newest first, with their score, or the
+    status of a check, and their number of findings.
+    """
+    params = []
+    if check:
+      query = ("SELECT r.ts, r.host, c.status, "
+               "(SELECT COUNT(*) FROM findings f "
+               " WHERE f.run = r.id AND f.check_name = c.check_name) "
+               "FROM runs r JOIN checks c ON c.run = r.id "
+               "WHERE c.check_name = ?")
+      params.append(check)
+    else:
+      query = ("SELECT r.ts, r.host, r.passed || '/' || r.total, "
+               "(SELECT COUNT(*) FROM findings f WHERE f.run = r.id) "
+               "FROM runs r WHERE 1")
+    if host:
+      query += " AND r.host = ?"
+      params.append(host)
+    query += " ORDER BY r.ts DESC, r.id DESC LIMIT ?"
+    params.append(limit)
+    return self.db.execute(query, params).fetchall()
+
+  def seen(self, host=None, check=None, container=None, image=None,
+           finding=None):
+    """
+    Returns when each matching finding was first and last seen, the
+    number of runs it was seen in, and whether the latest run of its
+    host still reports it. Containers are matched by ID prefix.
+    """
+    conds = []
+    params = []
+    if host:
+      conds.append("f.host = ?")
+      params.append(host)
+    if check:
+      conds.append("f.check_name = ?")
+      params.append(check)
+    if container:
+      conds.append("f.container GLOB ?")
+      params.append(glob_prefix(container))
+    if image:
+      conds.append("f.image = ?")
+      params.append(image)
+    if finding:
+      conds.append("f.finding LIKE ?")
+      params.append('%' + finding + '%')
+    query = ("SELECT f.host, f.check_name, f.container, f.image, f.finding, "
+             "MIN(f.ts), MAX(f.ts), COUNT(DISTINCT f.run), "
+             "MAX(f.ts) = (SELECT MAX(ts) FROM runs r WHERE r.host = f.host) "
+             "FROM findings f")
+    if conds:
+      query += " WHERE " + " AND ".join(conds)
+    query += (" GROUP BY f.host, f.check_name, f.container, f.finding "
+              "ORDER BY MIN(f.ts), f.host, f.check_name")
+    return self.db.execute(query, params).fetchall()
+
+  def close(self):
+    self.db.close()
+
+
+def glob_prefix(prefix):
+  """Escapes a prefix for a GLOB match, which can use indexes"""
+  return re.sub(r'([*?\[])', r'[\1]', prefix) + '*'
+
+
+def timestamp(ts):
+  return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+def print_trend(rows, check):
+  row = '%-19s %-24s %-10s %8s'
+  print(row %('date', 'host', 'status' if check else 'score', 'findings'))
+  for ts, host, status, findings in rows:
+    print(row %(timestamp(ts), host, status, findings))
+
+
+def print_seen(rows):
+  row = '%-19s %-19s %5s %-7s %-20s %-24s %-14s %s'
+  print(row %('first seen', 'last seen', 'runs', 'present', 'host', 'check',
+              'container', 'finding'))
+  for host, check, container, image, finding, first, last, runs, \
+      present in rows:
+    print(row %(timestamp(first), timestamp(last), runs,
+                'yes' if present else 'no', host, check,
+                (container or '-')[:12], finding))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Queries the audit history")
+  parser.add_argument("database", help="History database")
+  queries = parser.add_subparsers(dest="query")
+  trend = queries.add_parser("trend", help="Score or check status per run")
+  trend.add_argument("-H", "--host")
+  trend.add_argument("-c", "--check")
+  trend.add_argument("-n", "--runs", type=int, default=20)
+  seen = queries.add_parser("seen", help="First and last run of findings")
+  seen.add_argument("-H", "--host")
+  seen.add_argument("-c", "--check")
+  seen.add_argument("--container", help="Container ID or prefix")
+  seen.add_argument("--image")
+  seen.add_argument("-f", "--finding", help="Text in the finding")
+  args = parser.parse_args()
+
+  store = HistoryStore(args.database)
+  if args.query == 'trend':
+    print_trend(store.trend(args.host, args.check, args.runs), args.check)
+  else:
+    print_seen(store.seen(args.host, args.check, args.container, args.image,
+                          args.finding))
+  store.close()
+
+
+if __name__ == '__main__':
+  main()
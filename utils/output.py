@@ -1,15 +1,23 @@
-import sys
 import os
 import json
 import logging
 from collections import OrderedDict
 from datetime import datetime
-from colorama import init, Fore, Back, Style
-from junit_xml import TestSuite, TestCase
+from colorama import Fore, Style
+
+from utils.stream import NdjsonWriter, JunitWriter, SUITE_NAME, SECTIONS
+
+def collect_timings(audit_categories, cats):
+  """Returns the timings of the categories which ran and of their checks"""
+  timings = {}
+  for cat in cats:
+    audit = audit_categories.get(cat)
+    if audit is None or audit.category_timings is None:
+      continue
+    timings[cat] = {'total': audit.category_timings,
+                    'checks': dict(audit.timings)}
+  return timings
 
-from audits.host import HostConfAudit
-from audits.dock import DockerConfAudit, DockerFileAudit
-from audits.containers import ContainerImgAudit, ContainerRuntimeAudit
 
 class FormattedOutput:
 
@@ -22,60 +30,72 @@ class FormattedOutput:
 
   def audit_init_info(self,profile):
     info = {}
-    (passed, total) = self.get_score()
+    (passed, total, ran, planned) = self.get_score()
 
     info['date'] = str(datetime.now())
     info['profile'] = profile
     info['score'] = "%s/%s" %(passed,total)
+    info['coverage'] = "%s/%s" %(ran,planned)
     self.log['info'] = info
 
   def save_results(self,name,res):
     self.log[name] = res
 
+  def save_timings(self):
+    self.log['timings'] = collect_timings(self.audit_categories,
+                                          self.log.keys())
+
   def write_file(self):
     if os.path.isfile(self.output):
-      logging.warn("File exists,deleting...")
-      os.remove(self.output)
-    with open(self.output,'a') as f:
-      json_data = json.dumps(self.log,sort_keys=True,
-                 indent=4, separators=(',', ': '))
-     # print json_data
-      f.write(json_data)
+      logging.warn("File exists,overwriting...")
+    with open(self.output,'w') as f:
+      # Serialized straight to the file, without a copy in memory
+      json.dump(self.log,f,sort_keys=True,
+                indent=4, separators=(',', ': '))
+
+  def write_ndjson_file(self):
+    """Writes the results as one JSON record per line, info last"""
+    if os.path.isfile(self.output):
+      logging.warn("File exists,overwriting...")
+    with open(self.output,'w') as f:
+      writer = NdjsonWriter(f)
+      writer.results(self.log)
+      if 'timings' in self.log:
+        writer.timings(self.log['timings'])
+      writer.summary(self.log['info'])
 
   def write_xml_file(self):
-    test_cases = []
     if os.path.isfile(self.output):
-      logging.warn("File exists,deleting...")
-      os.remove(self.output)
-    with open(self.output,'a') as f:
-      for _, elements in self.log.items():
-        for j in elements.viewitems():
-          if j[0] == 'date' or j[0] == 'profile' or j[0] == 'score':
-            # we really don't care
-            pass
-          else:
-            try:
-              test_case = TestCase(j[0], j[1]['descr'], '', '', '')
-              if j[1]['status'] == 'Fail':
-                test_case.add_failure_info(j[1]['output'])
-              else:
-                test_case = TestCase(j[0], '', '', '', '')
-              test_cases.append(test_case)
-            except KeyError:
-              # the world's smallest violin playin' for KeyError
-              pass
-      ts = [TestSuite("Docker Security Benchmarks", test_cases)]
-      TestSuite.to_file(f, ts)
+      logging.warn("File exists,overwriting...")
+    with open(self.output,'w') as f:
+      writer = JunitWriter(f)
+      writer.suite(SUITE_NAME)
+      writer.results(self.log)
+      writer.summary(self.log['info'])
 
   def get_score(self):
     """
     Calculates benchmark score by taking account
-    results containing 'status' key
+    results containing 'status' key, and the coverage of the
+    run: returns passed and scored checks, and checks run out
+    of all checks planned. Checks skipped for lack of time
+    are left out of the score, and of the checks run
     """
     allchecks = 0
     passed = 0
+    ran = 0
+    planned = 0
     for cat,check in self.log.iteritems():
+      if cat in SECTIONS:
+        continue
       for result in check.iteritems():
+        planned = planned +1
+        try:
+          if (result[1]['status'] == 'Skipped'):
+            continue
+        except (TypeError, KeyError):
+          pass
+        ran = ran +1
         try:
           if (result[1]['status'] == 'Pass'):
             passed = passed +1
@@ -86,7 +106,7 @@ class FormattedOutput:
           continue
         except KeyError:
           continue
-    return passed, allchecks
+    return passed, allchecks, ran, planned
 
   def print_results(self,results):
     try:
@@ -94,6 +114,8 @@ class FormattedOutput:
         print ("Status: " + Fore.GREEN + 'Pass' + Fore.RESET)
       elif results['status'] == 'Fail':
         print ("Status: " + Fore.RED + 'Fail' + Fore.RESET)
+      elif results['status'] == 'Skipped':
+        print ("Status: " + Fore.YELLOW + 'Skipped' + Fore.RESET)
     except KeyError:
       pass
     except TypeError:
@@ -130,8 +152,8 @@ class FormattedOutput:
     print '''drydock v0.3 Audit Results\n==========================\n'''
     # Print results
     for cat, catdescr in auditcats.iteritems():
-      cat_inst = self.audit_categories[cat]
       try:
+        cat_inst = self.audit_categories[cat]
         if output[cat]:
           audits = self.create_ordereddict(output[cat],cat)
           print(Style.BRIGHT + "\n" + catdescr + "\n" + \
@@ -151,10 +173,42 @@ class FormattedOutput:
     print('Date: ' + output['info']['date'])
     success,total = output['info']['score'].split('/')
     success = float(success)
-    total = float(total)
+    total = float(total) or 1.0
     if 0 <= success/total <= 0.5:
       print('Score: ' + Fore.RED + output['info']['score'] + Fore.RESET)
     elif 0.5 < success/total <= 0.8:
       print('Score: ' + Fore.YELLOW + output['info']['score'] + Fore.RESET)
     else:
       print('Score: ' + Fore.GREEN + output['info']['score'] + Fore.RESET)
+    run, planned = output['info']['coverage'].split('/')
+    if run != planned:
+      print('Coverage: ' + Fore.YELLOW + output['info']['coverage'] + \
+            ' checks run, out of time' + Fore.RESET)
+
+  def print_timings(self):
+    """Prints the timings of categories and checks, slowest first"""
+    timings = self.log['timings']
+    row = '%-40s %10s %10s %10s %12s'
+    print(Style.BRIGHT + "\nTimings\n-------" + Style.RESET_ALL)
+    print(row %('Category / check', 'Wall (s)', 'CPU (s)', 'API calls',
+                'Bytes'))
+    bywall = lambda item: -item[1]['wall']
+    for cat, cattimings in sorted(timings.iteritems(),
+                                  key=lambda item: -item[1]['total']['wall']):
+      total = cattimings['total']
+      print(Style.BRIGHT + row %(cat, '%.3f' %total['wall'],
+                                 '%.3f' %total['cpu'], total['api_calls'],
+                                 total['bytes']) + Style.RESET_ALL)
+      for check, res in sorted(cattimings['checks'].iteritems(), key=bywall):
+        print(row %('  ' + check, '%.3f' %res['wall'], '%.3f' %res['cpu'],
+                    res['api_calls'], res['bytes']))
+      # Documents read by every check are fetched before the first one
+      shared = dict((key, total[key] - sum(res[key] for res in \
+                                           cattimings['checks'].itervalues()))
+                    for key in ('wall', 'cpu', 'api_calls', 'bytes'))
+      if shared['api_calls'] > 0:
+        print(Style.DIM + row %('  (shared prefetch)',
+                                '%.3f' %max(shared['wall'], 0),
+                                '%.3f' %max(shared['cpu'], 0),
+                                shared['api_calls'], shared['bytes']) + \
+              Style.RESET_ALL)
@@ -0,0 +1,124 @@
+import sys
+import json
+import logging
+import threading
+
+from audits.stats import Meter
+
+# Checks without @assign_order, e.g. profile rules, come after the others
+UNORDERED = sys.maxint
+
+
+def check_name(audit):
+  """Returns the name of a check in a profile category"""
+  if isinstance(audit, basestring):
+    return audit
+  name = audit.keys()[0]
+  if name == 'rule' and isinstance(audit[name], dict):
+    return audit[name].get('name', name)
+  return name
+
+
+def by_cost(audit, audits, costs):
+  """
+  Orders the checks of a category for a time-budgeted run, cheapest
+  first by the wall time they took before, then in benchmark order
+  (@assign_order). Checks without a recorded time, new or skipped last
+  time, come first, so that every check is eventually covered.
+  """
+  def cost(item):
+    name = check_name(item)
+    order = getattr(getattr(audit, name, None), 'order', UNORDERED)
+    return costs.get(name, 0), order
+  return sorted(audits, key=cost)
+
+
+def recorded_costs(path):
+  """
+  Returns the wall time of the checks of each category from the timings
+  of a JSON or NDJSON report, or nothing if it has none. The slowest
+  time over the hosts of a fleet report is kept.
+  """
+  sections = []
+  try:
+    with open(path) as f:
+      if path.endswith('.ndjson'):
+        for line in f:
+          if '"timings": ' in line:
+            sections.append(json.loads(line).get('timings'))
+      else:
+        log = json.load(f)
+        hosts = log.get('hosts', {'': log})
+        sections = [host.get('timings') for host in hosts.itervalues()]
+  except (IOError, ValueError, AttributeError) as e:
+    logging.debug("No check timings in %s: %s" %(path, e))
+    return {}
+  costs = {}
+  for timings in sections:
+    for cat, cattimings in (timings or {}).iteritems():
+      catcosts = costs.setdefault(cat, {})
+      for check, res in cattimings.get('checks', {}).iteritems():
+        catcosts[check] = max(catcosts.get(check, 0), res['wall'])
+  return costs
+
+
+def run_category(cat, audit, audits, results, deadline=None, costs=None):
+  """
+  Runs the audits of a category and stores its results. With a
+  deadline, checks run cheapest first and those not started by the
+  deadline are skipped. The deadline only applies to this run, not to
+  later re-evaluations such as those of watch mode.
+  """
+  if deadline is not None:
+    audit.deadline = deadline
+    audits = by_cost(audit, audits, (costs or {}).get(cat, {}))
+  try:
+    # Includes the work done before the checks, e.g. prefetches
+    with Meter() as meter:
+      audit.run_audits(audits)
+    audit.category_timings = meter.as_dict()
+    results[cat] = audit.logdict
+  except KeyError:
+    logging.error("No audit category '%s' defined." %cat)
+  finally:
+    audit.deadline = None
+
+
+def run_categories(audit_categories, profile, parallel=True, deadline=None,
+                   costs=None):
+  """
+  Runs every audit category present in the profile and returns a list
+  of (category, results) in the order of audit_categories.
+  Categories use independent resources (processes, files, Docker API),
+  so by default each one runs in its own thread. deadline is the time
+  after which no check is started, costs the recorded wall time of
+  checks by category.
+  """
+  results = {}
+  errors = []
+  threads = []
+  selected = [(cat, audit) for cat, audit in audit_categories.iteritems() \
+              if cat in profile.keys()]
+
+  def worker(cat, audit):
+    try:
+      run_category(cat, audit, profile[cat], results, deadline, costs)
+    except Exception:
+      errors.append(sys.exc_info())
+
+  for cat, audit in selected:
+    if parallel:
+      thread = threading.Thread(target=worker, args=(cat, audit),
+                                name="audit-%s" %cat)
+      thread.start()
+      threads.append(thread)
+    else:
+      run_category(cat, audit, profile[cat], results, deadline, costs)
+  for thread in threads:
+    thread.join()
+  # Fail like a serial run would
+  if errors:
+    exc_type, exc_value, exc_tb = errors[0]
+    raise exc_type, exc_value, exc_tb
+
+  return [(cat, results[cat]) for cat, _ in selected if cat in results]
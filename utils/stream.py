@@ -0,0 +1,249 @@
+import re
+import json
+import logging
+import threading
+
+SUITE_NAME = "Docker Security Benchmarks"
+# Report entries which are not audit categories
+SECTIONS = ('info', 'timings')
+# Room left in XML headers for the counts patched in at the end
+HEADER_PAD = 40
+# Counters of the testcases of each kind of result
+COUNTERS = {'failure': 'failures', 'error': 'errors', 'skipped': 'skipped'}
+ILLEGAL_XML = re.compile(u'[\x00-\x08\x0b-\x1f\x7f-\x84\x86-\x9f'
+                         u'\ud800-\udfff\ufdd0-\ufddf\ufffe\uffff]')
+
+
+def output_items(results):
+  """Returns the entries of a check's output, one per finding"""
+  try:
+    output = results['output']
+  except (KeyError, TypeError):
+    return []
+  if isinstance(output, dict):
+    return output.items()
+  elif isinstance(output, (list, tuple)):
+    return output
+  return [output]
+
+
+class NdjsonWriter(object):
+  """
+  Writes check results as newline delimited JSON. Each check is one
+  record, followed by one record per finding of its output, so records
+  are written as soon as a check finishes and no report is serialized
+  as a whole. Fields passed as keyword arguments (e.g. the host in fleet
+  mode) are added to every record.
+  """
+
+  def __init__(self, f, **fields):
+    self.file = f
+    self.fields = fields
+    self.lock = threading.Lock()
+
+  def record(self, **record):
+    record.update(self.fields)
+    self.file.write(json.dumps(record, sort_keys=True) + '\n')
+
+  def check(self, cat, name, results):
+    with self.lock:
+      if not isinstance(results, dict):
+        # Checks which could not run return nothing or a log call
+        self.record(category=cat, check=name, status=None)
+        self.file.flush()
+        return
+      items = output_items(results)
+      self.record(category=cat, check=name, status=results.get('status'),
+                  descr=results.get('descr'), findings=len(items))
+      for item in items:
+        self.record(category=cat, check=name, finding=item)
+      self.file.flush()
+
+  def timings(self, timings):
+    with self.lock:
+      self.record(timings=timings)
+
+  def summary(self, info):
+    """Closes the stream with the audit info and score"""
+    with self.lock:
+      self.record(info=info)
+      self.file.flush()
+
+  def results(self, log):
+    """Writes the results of finished categories"""
+    for cat, checks in sorted(log.iteritems()):
+      if cat in SECTIONS:
+        continue
+      for name, results in sorted(checks.iteritems()):
+        self.check(cat, name, results)
+
+
+def xml_attr(value):
+  """Formats an attribute value like junit_xml does"""
+  if isinstance(value, str):
+    value = value.decode('utf-8')
+  elif not isinstance(value, unicode):
+    value = unicode(value)
+  value = ILLEGAL_XML.sub(u'', value)
+  return value.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+              .replace(u'"', u'&quot;').replace(u'>', u'&gt;')
+
+
+class JunitWriter(object):
+  """
+  Writes check results as JUnit XML, one testcase at a time. The
+  document has the schema and layout of junit_xml reports. Test and
+  failure counts are only known at the end, so the testsuite headers
+  are written with room to spare and rewritten when a suite closes.
+  """
+
+  def __init__(self, f):
+    self.file = f
+    self.lock = threading.Lock()
+    self.totals = self.counts()
+    self.current = None
+    self.write(u'<?xml version="1.0" ?>\n')
+    self.root = self.header(u'testsuites', self.totals)
+
+  def counts(self):
+    return {'errors': 0, 'failures': 0, 'skipped': 0, 'tests': 0}
+
+  def header(self, tag, counts, prefix=u'', name=None):
+    """Writes a header to be patched later and returns its offset"""
+    self.write(prefix)
+    offset = self.file.tell()
+    self.write(self.start_tag(tag, counts, name) + u' '*HEADER_PAD + u'>\n')
+    return offset, len(self.start_tag(tag, counts, name)) + HEADER_PAD
+
+  def start_tag(self, tag, counts, name=None):
+    if name is None:
+      return u'<%s disabled="0" errors="%d" failures="%d" tests="%d" '\
+             u'time="0.0"' %(tag, counts['errors'], counts['failures'],
+                             counts['tests'])
+    return u'<%s disabled="0" errors="%d" failures="%d" name="%s" '\
+           u'skipped="%d" tests="%d" time="0"' %(tag, counts['errors'],
+                                                 counts['failures'],
+                                                 xml_attr(name),
+                                                 counts['skipped'],
+                                                 counts['tests'])
+
+  def patch(self, header, text):
+    offset, width = header
+    end = self.file.tell()
+    self.file.seek(offset)
+    self.write(text.ljust(width))
+    self.file.seek(end)
+
+  def write(self, text):
+    self.file.write(text.encode('utf-8'))
+
+  def suite(self, name):
+    """Starts a testsuite, closing the previous one"""
+    with self.lock:
+      self.close_suite()
+      self.current = (name, self.counts())
+      self.suite_header = self.header(u'testsuite', self.current[1],
+                                      u'\t', name)
+
+  def close_suite(self):
+    if self.current is None:
+      return
+    name, counts = self.current
+    self.write(u'\t</testsuite>\n')
+    self.patch(self.suite_header, self.start_tag(u'testsuite', counts, name))
+    self.current = None
+
+  def testcase(self, name, classname=None, kind=None, message=None):
+    counts = self.current[1]
+    attrs = u''
+    if classname:
+      attrs += u' classname="%s"' %xml_attr(classname)
+    attrs += u' name="%s"' %xml_attr(name)
+    if kind:
+      self.write(u'\t\t<testcase%s>\n\t\t\t<%s message="%s" type="%s"/>\n'\
+                 u'\t\t</testcase>\n' %(attrs, kind, xml_attr(message), kind))
+      counts[COUNTERS[kind]] += 1
+      self.totals[COUNTERS[kind]] += 1
+    else:
+      self.write(u'\t\t<testcase%s/>\n' %attrs)
+    counts['tests'] += 1
+    self.totals['tests'] += 1
+
+  def check(self, cat, name, results):
+    with self.lock:
+      try:
+        descr = results['descr']
+        if results['status'] == 'Skipped':
+          self.testcase(name, descr, 'skipped', descr)
+        elif results['status'] != 'Fail':
+          self.testcase(name)
+        elif results['output']:
+          self.testcase(name, descr, 'failure', results['output'])
+        else:
+          self.testcase(name, descr)
+      except (KeyError, TypeError):
+        # Results without a status are not tests
+        pass
+      self.file.flush()
+
+  def error(self, name, message):
+    with self.lock:
+      self.testcase(name, kind='error', message=message)
+
+  def summary(self, info):
+    """Closes the document and writes the final counts"""
+    with self.lock:
+      self.close_suite()
+      self.write(u'</testsuites>\n')
+      self.patch(self.root, self.start_tag(u'testsuites', self.totals))
+      self.file.flush()
+
+  def results(self, log):
+    for cat, checks in sorted(log.iteritems()):
+      if cat in SECTIONS:
+        continue
+      for name, results in sorted(checks.iteritems()):
+        self.check(cat, name, results)
+
+
+class ResultStream(object):
+  """
+  Streams the results of a run to an NDJSON or JUnit XML file while
+  the audit categories are running. Unless keep_output is set, the
+  output of each check is dropped once written, only its status and
+  description stay in the results.
+  """
+
+  def __init__(self, outfile, fmt='ndjson', keep_output=False):
+    self.file = open(outfile, 'w')
+    self.fmt = fmt
+    self.keep_output = keep_output
+    if fmt == 'xml':
+      self.writer = JunitWriter(self.file)
+      self.writer.suite(SUITE_NAME)
+    else:
+      self.writer = NdjsonWriter(self.file)
+    self.audits = []
+
+  def attach(self, audit_categories):
+    """Hooks the writer to the check results of every category"""
+    for cat, audit in audit_categories.iteritems():
+      audit.on_result = self.hook(cat)
+      self.audits.append(audit)
+
+  def hook(self, cat):
+    def on_result(name, results):
+      self.writer.check(cat, name, results)
+      if not self.keep_output and isinstance(results, dict):
+        results.pop('output', None)
+    return on_result
+
+  def close(self, info, timings=None):
+    for audit in self.audits:
+      audit.on_result = None
+    if timings and self.fmt == 'ndjson':
+      # JUnit reports have no place for them
+      self.writer.timings(timings)
+    self.writer.summary(info)
+    self.file.close()
+    logging.debug("Streamed results to %s" %self.file.name)
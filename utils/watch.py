@@ -0,0 +1,171 @@
+import sys
+import json
+import time
+import logging
+
+from audits.verdicts import VerdictCache
+from utils.scheduler import check_name
+from utils.stream import output_items
+
+# Container categories re-evaluated on events
+WATCHED = ('container_imgs', 'container_runtime')
+STARTED = ('start',)
+STOPPED = ('die', 'destroy')
+# Paused containers are still listed as running and audited
+CHANGED = ('update', 'rename', 'pause', 'unpause')
+RECONNECT_DELAY = 5
+
+
+def findings(results):
+  """Returns the output entries of check results as comparable strings"""
+  return set(json.dumps(item, sort_keys=True) \
+             for item in output_items(results))
+
+
+def entry_keys(results):
+  """
+  Returns the container IDs and image names the output entries of check
+  results refer to, e.g. ["ID", ...], [(mounts, "ID"), ...] or
+  {"image": {"containers": [...]}}
+  """
+  keys = set()
+  for item in output_items(results):
+    parts = item if isinstance(item, (list, tuple)) else [item]
+    for part in parts:
+      if isinstance(part, basestring):
+        keys.add(part)
+      elif isinstance(part, dict):
+        keys.update(part.get('containers') or [])
+  return keys
+
+
+def status(results):
+  try:
+    return results['status']
+  except (KeyError, TypeError):
+    return None
+
+
+class Watcher(object):
+  """
+  Keeps the results of the container categories current by following
+  the daemon's events stream. Only the containers named by events are
+  fetched again, and the changes of each event are emitted as deltas.
+  Each check is re-run over the container of the event and the
+  containers its previous results name, not over all containers.
+  """
+
+  def __init__(self, session, audit_categories, profile, on_change=None):
+    self.session = session
+    self.categories = [(cat, audit_categories[cat]) for cat in WATCHED \
+                       if cat in profile]
+    self.profile = profile
+    self.on_change = on_change
+    # Verdicts of unchanged containers are reused on every event
+    if session.verdicts is None:
+      session.verdicts = VerdictCache()
+
+  def run(self, since):
+    """Follows events until interrupted, reconnecting when needed"""
+    try:
+      while True:
+        try:
+          for event in self.session.cli.events(since=since, decode=True):
+            since = event.get('time', since)
+            self.handle(event)
+        except Exception as e:
+          logging.info("Events stream interrupted (%s), reconnecting" %e)
+          time.sleep(RECONNECT_DELAY)
+    except KeyboardInterrupt:
+      logging.info("Stopped watching events")
+
+  def handle(self, event):
+    if event.get('Type', 'container') != 'container':
+      return
+    action = event.get('status') or event.get('Action')
+    container = event.get('id') or event.get('Actor', {}).get('ID')
+    if not container or action not in STARTED + STOPPED + CHANGED:
+      return
+    logging.info("Container %s: %s" %(container, action))
+    if action in STARTED:
+      self.session.container_started(container)
+    elif action in STOPPED:
+      self.session.container_stopped(container)
+    else:
+      self.session.snapshot.invalidate(container)
+
+    changes = []
+    for cat, audit in self.categories:
+      previous = dict(audit.logdict)
+      audit.refresh()
+      self.recheck(audit, self.profile[cat], container)
+      changes += self.compare(cat, previous, audit.logdict)
+    if changes:
+      self.emit({'time': event.get('time'), 'container': container,
+                 'action': action, 'changes': changes})
+      if self.on_change:
+        self.on_change()
+
+  def recheck(self, audit, audits, container):
+    """
+    Runs the checks of a category over the containers whose results may
+    have changed. Checks report each container (or the containers of an
+    image) on its own, so the results over the container of the event
+    and the containers previously reported equal those over all
+    containers, for the documents of unchanged containers are cached.
+    """
+    running = audit.running
+    if not running:
+      audit.run_audits(audits)
+      return
+    # Positions keep the order of containers in the results
+    position = dict((cont, i) for i, cont in enumerate(running))
+    owners = None
+    try:
+      for entry in audits:
+        keys = entry_keys(audit.logdict.get(check_name(entry)))
+        keys.add(container)
+        if owners is None and \
+           any(key not in position and key != container for key in keys):
+          owners = self.owners(audit, running)
+        subset = set(key for key in keys if key in position)
+        for key in keys:
+          subset.update((owners or {}).get(key, ()))
+        audit.running = sorted(subset, key=position.get)
+        audit.run_audits([entry])
+    finally:
+      audit.running = running
+
+  def owners(self, audit, running):
+    """Returns the running containers by image ID and image name"""
+    owners = {}
+    for cont in running:
+      try:
+        info = audit.snapshot.inspect(cont)
+      except Exception as e:
+        logging.debug("Unable to inspect %s: %s" %(cont, e))
+        continue
+      for key in (info.get('Image'), (info.get('Config') or {}).get('Image')):
+        owners.setdefault(key, []).append(cont)
+    return owners
+
+  def compare(self, cat, previous, current):
+    """Lists the checks of a category whose results changed"""
+    changes = []
+    for check in sorted(current):
+      old, new = previous.get(check), current[check]
+      added = findings(new) - findings(old)
+      removed = findings(old) - findings(new)
+      if status(old) == status(new) and not added and not removed:
+        continue
+      changes.append({'category': cat,
+                      'check': check,
+                      'status': [status(old), status(new)],
+                      'added': [json.loads(item) for item in sorted(added)],
+                      'removed': [json.loads(item) for item in sorted(removed)],
+                      })
+    return changes
+
+  def emit(self, delta):
+    sys.stdout.write(json.dumps(delta, sort_keys=True) + '\n')
+    sys.stdout.flush()